@@ -18,6 +18,10 @@
 
 import sys
 import os
+import io
+import copy
+import shutil
+import functools
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QTabWidget, QLineEdit, QTextEdit, QListWidgetItem
 from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QListWidget, QComboBox, QLabel, QMessageBox
 from PyQt5.QtGui import QFont
@@ -25,16 +29,25 @@ from PyQt5.QtCore import Qt
 
 import pyqtgraph as pg
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import scipy.optimize
 import scipy.special
 import scipy.signal
-import scipy.integrate
 
 import numpy as np
 
 import fnmatch
 
+# numba is optional, without it the line shape kernels run as plain numpy code
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 
 # physical constants
 mu0 = 1.2566e-6
@@ -43,17 +56,149 @@ h = 6.626e-34
 e = 1.602e-19
 me = 9.11e-31
 
+# gamma / (2 pi) per unit g-factor, gamma_prime = g * K_GAMMA
+K_GAMMA = e / (4.0 * np.pi * me)
+
+
+# compiled line shape kernels, wrapped by the Fit class
+# The difference d = B - B0 and the denominator are computed once per call and
+# updated in place, which keeps the number of temporary arrays small.
+# https://journals.aps.org/prb/pdf/10.1103/PhysRevB.84.054423
+@njit(cache=True, fastmath=True, nogil=True)
+def _lorentz_derivative(B, A, B0, Gamma, offset):
+    d = B - B0
+    D = d * d
+    D += Gamma**2
+    D *= D
+    y = d * (-A * Gamma**2)
+    y /= D
+    y += offset
+    return y
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _lorentz_derivative_jac(B, A, B0, Gamma, offset):
+    # analytical Jacobian of lorentz_derivative with respect to (A, B0, Gamma, offset)
+    d = B - B0
+    d2 = d * d
+    D = d2 + Gamma**2
+    inv2 = D**-2
+    inv3 = inv2 / D
+    jac = np.empty((B.shape[0], 4))
+    jac[:, 0] = -Gamma**2 * d * inv2
+    jac[:, 1] = A * Gamma**2 * (Gamma**2 - 3 * d2) * inv3
+    jac[:, 2] = -2 * A * Gamma * d * (d2 - Gamma**2) * inv3
+    jac[:, 3] = 1.0
+    return jac
+
+
+# https://pubs.aip.org/aip/jap/article/117/14/143902/138614/Eddy-current-interactions-in-a-ferromagnet-normal
+@njit(cache=True, fastmath=True, nogil=True)
+def _asymmetric_lorentz_derivative(B, A, B0, Gamma, offset, beta):
+    # field derivative of the asymmetric Lorentz line shape
+    # l = A Gamma^2 (1 + 2 beta (B0 - B)/Gamma) / ((B0 - B)^2 + Gamma^2)
+    d = B - B0
+    D = d * d
+    # numerator N = beta (d^2 - Gamma^2) - d Gamma
+    y = D - Gamma**2
+    y *= beta
+    y -= Gamma * d
+    y *= 2 * A * Gamma
+    D += Gamma**2
+    D *= D
+    y /= D
+    y += offset
+    return y
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _asymmetric_lorentz_derivative_jac(B, A, B0, Gamma, offset, beta):
+    # analytical Jacobian of asymmetric_lorentz_derivative with respect to (A, B0, Gamma, offset, beta)
+    d = B - B0
+    d2 = d * d
+    D = d2 + Gamma**2
+    N = beta * (d2 - Gamma**2) - d * Gamma
+    inv2 = D**-2
+    inv3 = inv2 / D
+
+    jac = np.empty((B.shape[0], 5))
+    jac[:, 0] = 2 * Gamma * N * inv2
+    jac[:, 1] = -2 * A * Gamma * ((2 * beta * d - Gamma) * D - 4 * d * N) * inv3
+    jac[:, 2] = 2 * A * ((N - 2 * beta * Gamma**2 - d * Gamma) * D - 4 * Gamma**2 * N) * inv3
+    jac[:, 3] = 1.0
+    jac[:, 4] = 2 * A * Gamma * (d2 - Gamma**2) * inv2
+    return jac
+
+
+# mean and positions of the minimum and maximum of a signal in a single pass
+@njit(cache=True, nogil=True)
+def _yscan(y):
+    s = 0.0
+    imin = 0
+    imax = 0
+    vmin = y[0]
+    vmax = y[0]
+    for i in range(len(y)):
+        v = y[i]
+        s += v
+        if v < vmin:
+            vmin = v
+            imin = i
+        if v > vmax:
+            vmax = v
+            imax = i
+    return s / len(y), imin, imax
+
+
+# linear linewidth model of the damping analysis
+@njit(cache=True, fastmath=True, nogil=True)
+def _damping(f, alpha, deltaB0, gamma_prime):
+    return alpha * f / gamma_prime + deltaB0
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _damping_jac(f, alpha, deltaB0, gamma_prime):
+    # analytical Jacobian of _damping with respect to (alpha, deltaB0)
+    jac = np.empty((f.shape[0], 2))
+    jac[:, 0] = f / gamma_prime
+    jac[:, 1] = 1.0
+    return jac
+
+
+def _load_dataset(zf, file):
+    # parse the two columns (field, voltage) of one measurement file in one go
+    with zf.open(file) as handle:
+        data = np.loadtxt(handle, usecols=(0, 1), dtype=np.float64, ndmin=2)
+    # store each dataset as a (fields, voltages) tuple of contiguous
+    # float64 arrays, so that the fits can use them without copies
+    fields = np.ascontiguousarray(data[:, 0])
+    voltages = np.ascontiguousarray(data[:, 1])
+    return fields, voltages
+
+
+def _fit_one(dataset, fitProfile):
+    # line fit of a single dataset, runs in a worker process of fitAll
+    fit = Fit()
+    fit_result = fit.LineFit(dataset, fitProfile)
+    # evaluate the fit on the measured field grid, the plot interpolates between the points
+    x = dataset[0]
+    kernel = fit._profile_fn.get(fitProfile, fit.voigt_derivative)
+    fitted_y = kernel(x, *fit_result[0])
+    return fit_result, [x, fitted_y]
+
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.datasets = []  # store datasets
-        self.frequencies = []  # store frequencies
+        self.frequencies = np.empty(0)  # store frequencies (GHz)
         self.fitparameters = []  # store fit parameters/results
         self.linefits = [] # store the line fits
         self.fitPlotItems = []  # store references to fit plot items
         self.DataPlotItems = []  # store references to fit plot items
         self.checked = []  # store the checked status of each dataset
+        self._fit = Fit()  # fitting routines, reused for all datasets
+        self._pool = None  # worker processes for the line fits, started on first use
         self.initUI()
         
         # To store the Kittel analysis, first list is extracted resonances, second list is the fit.
@@ -98,6 +243,10 @@ class MainWindow(QMainWindow):
         self.KittelPlot.getAxis('left').setPen(color='#000000')
         self.KittelPlot.getAxis('bottom').setPen(color='#000000')
         
+        # persistent curves, updated with setData after each fit
+        self.KittelDataItem = self.KittelPlot.plot([], [], symbol='o', symbolSize=8, pen=None, symbolBrush='b')
+        self.KittelFitItem = self.KittelPlot.plot([], [], pen=pg.mkPen('r', width=2))
+        
         self.subPlotLayout.addWidget(self.KittelPlot)
         
         # linewidth analysis plot       
@@ -110,6 +259,12 @@ class MainWindow(QMainWindow):
         self.linewidthPlot.getAxis('left').setPen(color='#000000')
         self.linewidthPlot.getAxis('bottom').setPen(color='#000000')        
         
+        # persistent curves, the sigma entry is only shown in the legend for the Voigt profile
+        self.linewidthLegend = self.linewidthPlot.addLegend()
+        self.gammaItem = self.linewidthPlot.plot([], [], symbol='o', symbolSize=8, pen=None, symbolBrush='r', name="gamma")
+        self.sigmaItem = self.linewidthPlot.plot([], [], symbol='o', symbolSize=8, pen=None, symbolBrush='b')
+        self.linewidthFitItem = self.linewidthPlot.plot([], [], pen=pg.mkPen('g', width=2))
+        
         self.subPlotLayout.addWidget(self.linewidthPlot)
         
         # Add Sub Plot Layout to Main Plot Layout
@@ -200,6 +355,7 @@ class MainWindow(QMainWindow):
         self.datasets, self.frequencies, frequency_files = self.loadDatasets(fileName)
         self.dataOverview.clear()
         self.DataPlotItems.clear()
+        self.fitPlotItems.clear()
         
         # Clear existing tabs except for the "All" tab
         for i in range(self.tabWidget.count() - 1, 0, -1):
@@ -221,34 +377,24 @@ class MainWindow(QMainWindow):
             plotItem = plotWidget.plot(self.datasets[i][0], self.datasets[i][1], pen=pen)
             self.tabWidget.addTab(plotWidget, file)
             self.DataPlotItems.append(plotItem)
+            # empty fit curve, filled by fitAll
+            self.fitPlotItems.append(plotWidget.plot([], [], pen=pg.mkPen('k', width=1)))  # Plot in black with a width of 1 pixels
     
             # Plot the data in the "All" tab with the same pen
             self.allPlot.plot(self.datasets[i][0], self.datasets[i][1], pen=pen)
 
 
     def loadDatasets(self, zipfilename):
-        zf = zipfile.ZipFile(zipfilename, mode="r")
-        files = zf.namelist()
-
-        frequency_files = []
-        frequencies = []
-        datasets = []
-
-        for file in files:
-            if file.endswith(".txt"):
-                frequency_files.append(file)
-                frequencies.append(float(file.strip("GHz.txt")))
-                handle = zf.open(file)
-                content = handle.read()
-                handle.close()
-                c = content.decode()
-                lines = c.split("\n")
-                fields, voltages = [], []
-                for line in lines[0:-1]:
-                    f, v = line.split()
-                    fields.append(float(f))
-                    voltages.append(float(v))
-                datasets.append([fields, voltages])
+        with zipfile.ZipFile(zipfilename, mode="r") as zf:
+            files = zf.namelist()
+
+            frequency_files = [file for file in files if file.endswith(".txt")]
+            frequencies = np.array([float(file[:-len("GHz.txt")]) for file in frequency_files])
+
+            # decompress and parse the members in parallel, the reads from the
+            # shared zip file handle are serialized by zipfile itself
+            with ThreadPoolExecutor() as executor:
+                datasets = list(executor.map(lambda file: _load_dataset(zf, file), frequency_files))
 
         return datasets, frequencies, frequency_files
     
@@ -260,50 +406,62 @@ class MainWindow(QMainWindow):
         # Clear previous fit results
         self.fitparameters.clear()
         self.clearAndReplotOriginalData()
-        self.KittelPlot.clear()
-        self.linewidthPlot.clear()
         self.linefits.clear()
 
         self.checked = []
                 
-        # Fitting routine for resonance lines
+        # Fitting routine for resonance lines, the datasets are fitted in parallel
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+        
+        futures = {}
         for i, dataset in enumerate(self.datasets):
             if self.dataOverview.item(i).checkState() != Qt.Checked:
                 self.checked.append(False)
                 continue
             else:
                 self.checked.append(True)
-            fit = Fit()
-            fit_result = fit.LineFit(dataset, fitProfile)
-            self.fitparameters.append(fit_result)
-            # oversample the fit x-axis and fit
-            x = np.linspace(dataset[0][0], dataset[0][-1], len(dataset[0]) * 4)
-            fitted_y = fit.calculateFittedLine(x, fit_result[0], fitProfile)
-            
-            # store line fit
-            self.linefits.append([x, fitted_y])
-            
-            # Get the plot widget for the corresponding dataset and plot fit
-            plotWidget = self.tabWidget.widget(i + 1)  # +1 because the first tab is "All Data"
-            fitPlotItem = plotWidget.plot(x, fitted_y, pen=pg.mkPen('k', width=1))  # Plot in black with a width of 1 pixels
-            self.fitPlotItems.append(fitPlotItem)
+            futures[self._pool.submit(_fit_one, dataset, fitProfile)] = i
+        
+        results = {}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+        
+        # plot in the order of the datasets, with a single repaint at the end
+        self.tabWidget.setUpdatesEnabled(False)
+        try:
+            for i in sorted(results):
+                fit_result, linefit = results[i]
+                x, fitted_y = linefit
+                self.fitparameters.append(fit_result)
+                
+                # store line fit
+                self.linefits.append(linefit)
+                
+                # update the fit curve of the corresponding dataset
+                self.fitPlotItems[i].setData(x, fitted_y)
+        finally:
+            self.tabWidget.setUpdatesEnabled(True)
+            self.tabWidget.update()
          
-        resonance_fields = [fit_param[0][1] for fit_param in self.fitparameters]  
-        resonance_frequencies = np.array(self.frequencies)[self.checked]
+        # fit parameters of all lines, one row per dataset
+        P = np.stack([fit_param[0] for fit_param in self.fitparameters])
+        resonance_fields = P[:, 1]
+        resonance_frequencies = self.frequencies[self.checked]
+        resonance_frequencies_Hz = resonance_frequencies * 1e9
 
         # Plotting the fit results as big blue circles in the Kittel plot
-        self.KittelPlot.plot(resonance_fields, resonance_frequencies, symbol='o', symbolSize=8, pen=None, symbolBrush='b')
+        self.KittelDataItem.setData(resonance_fields, resonance_frequencies)
 
         # Perform and plot Kittel fit
         # Plot Kittel fit curve
-        resonance_fields = [fit_param[0][1] for fit_param in self.fitparameters]  
-        fit = Fit()
+        fit = self._fit
         x_fit, y_fit, p, pcov = fit.KittelFit(resonance_fields, resonance_frequencies, mode)
         errors = np.sqrt(np.diagonal(pcov))
 
         g = p[1]*1e9
 
-        self.KittelPlot.plot(x_fit, y_fit, pen=pg.mkPen('r', width=2))
+        self.KittelFitItem.setData(x_fit, y_fit)
         
         # store the Kittel results
         self.KittelAnalysis = [[resonance_fields, resonance_frequencies], [x_fit, y_fit]] 
@@ -314,43 +472,45 @@ class MainWindow(QMainWindow):
         message += "g-factor      : %10.3f +/- %10.3f\n" % (g, errors[1]*1e9)
         
         # Plotting the fit results as big circles in the linewidth plot
-        self.linewidthPlot.addLegend()
+        self.linewidthLegend.removeItem(self.sigmaItem)
+        self.sigmaItem.setData([], [])
         
         gammas, sigmas = None, None
         
         if fitProfile == "Lorentz" or fitProfile == "Asymmetric Lorentz":
-             gammas = [fit_param[0][2] for fit_param in self.fitparameters]
+             gammas = P[:, 2]
              widths = gammas
-             self.linewidthPlot.plot(resonance_frequencies, gammas, symbol='o', symbolSize=8, pen=None, symbolBrush='r', name="gamma")
+             self.gammaItem.setData(resonance_frequencies, gammas)
                      
         else: # Voigt profile
-            gammas = [fit_param[0][2] for fit_param in self.fitparameters]  
-            sigmas = [fit_param[0][3] for fit_param in self.fitparameters] 
+            gammas = P[:, 2]
+            sigmas = P[:, 3]
             widths = gammas
-            self.linewidthPlot.plot(resonance_frequencies, gammas, symbol='o', symbolSize=8, pen=None, symbolBrush='r', name="gamma")
-            self.linewidthPlot.plot(resonance_frequencies, sigmas, symbol='o', symbolSize=8, pen=None, symbolBrush='b', name="sigma")
+            self.gammaItem.setData(resonance_frequencies, gammas)
+            self.sigmaItem.setData(resonance_frequencies, sigmas)
+            self.linewidthLegend.addItem(self.sigmaItem, "sigma")
             
         # perform and plot the linewidth linear fit
-        gamma_prime = g*e/(2*me) / (2*np.pi)
+        gamma_prime = g*K_GAMMA
         
-        x_fit, y_fit, p, pcov = fit.DampingFit(np.array(resonance_frequencies)*1e9, widths, gamma_prime)
+        x_fit, y_fit, p, pcov = fit.DampingFit(resonance_frequencies_Hz, widths, gamma_prime)
         errors = np.sqrt(np.diagonal(pcov))
 
         message += "\n\nLINEWIDTH ANALYSIS:\n"
         message += "alpha          : %8.5f +- %8.5f\n" % (p[0], errors[0])
         message += "DeltaB(0) HWHM : %8.5f +- %8.5f T\n" % (p[1], errors[1])
         
-        self.linewidthPlot.plot(x_fit/1e9, y_fit, pen=pg.mkPen('g', width=2))
+        self.linewidthFitItem.setData(x_fit/1e9, y_fit)
         
         # store the linewidth analysis 
-        if sigmas == None:
+        if sigmas is None:
             self.LinewidthAnalysis = [[resonance_frequencies, gammas], [x_fit, y_fit]] 
         else: # only relevant for Voigt profil
             self.LinewidthAnalysis = [[resonance_frequencies, gammas, sigmas], [x_fit, y_fit]] 
         
         if fitProfile == "Asymmetric Lorentz":
             message += "\n\nASYMMETRIC LORENTZ ANALYSIS:\n"
-            betas = [fit_param[0][4] for fit_param in self.fitparameters]
+            betas = P[:, 4]
             message += "%12s %12s\n" % ("f (GHz)", "beta")
             for f, beta in zip (resonance_frequencies, betas):
                 message += "%12.2f %12.6f\n" % (f, beta)
@@ -359,36 +519,55 @@ class MainWindow(QMainWindow):
         self.report = message
         
             
+    def closeEvent(self, event):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
+
+
     def clearAndReplotOriginalData(self):
-        for i, plotItem in enumerate(self.DataPlotItems):
-            plotWidget = self.tabWidget.widget(i + 1)  # +1 for "All Data" tab
-            plotWidget.clear()  # Clear the plot
-            plotWidget.addItem(plotItem)  # Re-add the original plot item
+        # the data curves stay in place, only the fit curves are emptied
+        for fitPlotItem in self.fitPlotItems:
+            fitPlotItem.setData([], [])
+        for item in (self.KittelDataItem, self.KittelFitItem, self.gammaItem, self.sigmaItem, self.linewidthFitItem):
+            item.setData([], [])
+
 
+    def xystring(self, x, y, header=""):
+        # two column text block, formatted by numpy in one pass
+        buf = io.StringIO()
+        np.savetxt(buf, np.column_stack([x, y]), fmt="%14.10f", header=header)
+        return buf.getvalue()
 
-    def writedatafile(self, zipfilename, filename, string):
-        zf = zipfile.ZipFile(zipfilename, mode="a")    
+
+    def writedatafile(self, zf, filename, string):
+        # zf is the open zip file of the whole export pass
         zf.writestr(filename, string)
-        zf.close()
         
         
     def remove_files_from_zip(self, zip_filename, patterns):
-        # Create a temporary ZIP file
-        temp_zip_filename = zip_filename + '.tmp'
-        
         with zipfile.ZipFile(zip_filename, 'r') as zip_read:
-            # Create a new ZIP file
+            items = zip_read.infolist()
+            # find the files matching any of the patterns
+            remove = {item.filename for item in items
+                      if any(fnmatch.fnmatch(item.filename, pattern) for pattern in patterns)}
+            
+            # nothing to remove, keep the file as it is
+            if not remove:
+                return
+            
+            # Create a temporary ZIP file
+            temp_zip_filename = zip_filename + '.tmp'
+            
             with zipfile.ZipFile(temp_zip_filename, 'w') as zip_write:
-                # Copy all files, except those matching any of the patterns
-                for item in zip_read.infolist():
-                    # Check if the file matches any of the patterns
-                    if not any(fnmatch.fnmatch(item.filename, pattern) for pattern in patterns):
-                        data = zip_read.read(item.filename)
-                        zip_write.writestr(item, data)
+                # Copy all other files, streamed in chunks with their original compression
+                for item in items:
+                    if item.filename not in remove:
+                        with zip_read.open(item) as src, zip_write.open(copy.copy(item), 'w') as dst:
+                            shutil.copyfileobj(src, dst, 64 * 1024)
         
-        # Replace the old ZIP file with the new one (optional)
-        os.remove(zip_filename)
-        os.rename(temp_zip_filename, zip_filename)
+        # Replace the old ZIP file with the new one
+        os.replace(temp_zip_filename, zip_filename)
         
 
     def export(self):
@@ -396,56 +575,56 @@ class MainWindow(QMainWindow):
         remove_patterns = ["*.xy", "Report.log"]
         self.remove_files_from_zip(self.fileNameTextbox.text(), remove_patterns)
         
+        # write all results through a single handle to the zip file
+        with zipfile.ZipFile(self.fileNameTextbox.text(), mode="a") as zf:
+            self._export_all(zf)
+
+        # show confirmation message
+        msgBox = QMessageBox()
+        msgBox.setWindowTitle("Export Confirmation")
+        msgBox.setText("Data exported to %s." % self.fileNameTextbox.text())
+        msgBox.setStandardButtons(QMessageBox.Ok)
+        msgBox.exec_()        
+
+
+        return
+
+
+    def _export_all(self, zf):
         # export the line fits
-        freqs = np.array(self.frequencies)[self.checked].tolist()
+        freqs = self.frequencies[self.checked]
         for i, freq in enumerate(freqs):
             fname = "%.2fGHz.xy" % freq
-            string = ""
-            for b, f in zip(self.linefits[i][0], self.linefits[i][1]):
-                string += "%14.10f %14.10f\n" % (b, f)
-            self.writedatafile(self.fileNameTextbox.text(), fname, string)
+            string = self.xystring(self.linefits[i][0], self.linefits[i][1])
+            self.writedatafile(zf, fname, string)
                     
         # export the Kittel data
-        string = "# resonance field (T), resonance frequency (GHz)\n"
-        for b, f in zip(self.KittelAnalysis[0][0], self.KittelAnalysis[0][1]):
-            string += "%14.10f %14.10f\n" % (b, f)
-        self.writedatafile(self.fileNameTextbox.text(), "KittelData.xy", string)
+        string = self.xystring(self.KittelAnalysis[0][0], self.KittelAnalysis[0][1], "resonance field (T), resonance frequency (GHz)")
+        self.writedatafile(zf, "KittelData.xy", string)
         
         # export the Kittel fit
-        string = "# resonance field (T), resonance frequency (GHz)\n"
-        for b, f in zip(self.KittelAnalysis[1][0], self.KittelAnalysis[1][1]):
-            string += "%14.10f %14.10f\n" % (b, f)
-        self.writedatafile(self.fileNameTextbox.text(), "KittelFit.xy", string)
+        string = self.xystring(self.KittelAnalysis[1][0], self.KittelAnalysis[1][1], "resonance field (T), resonance frequency (GHz)")
+        self.writedatafile(zf, "KittelFit.xy", string)
         
         
         # export the linewidth data
-        string = "# resonance frequency (GHz), linewidth (T)\n"
-        for b, f in zip(self.LinewidthAnalysis[0][0], self.LinewidthAnalysis[0][1]):
-            string += "%14.10f %14.10f\n" % (b, f)
-        self.writedatafile(self.fileNameTextbox.text(), "LinewidthData.xy", string)
+        string = self.xystring(self.LinewidthAnalysis[0][0], self.LinewidthAnalysis[0][1], "resonance frequency (GHz), linewidth (T)")
+        self.writedatafile(zf, "LinewidthData.xy", string)
         
         # export the linewidth fit
-        string = "# resonance frequency (GHz), linewidth (T)\n"
-        for b, f in zip(self.LinewidthAnalysis[1][0], self.LinewidthAnalysis[1][1]):
-            string += "%14.10f %14.10f\n" % (b*1e-9, f)
-        self.writedatafile(self.fileNameTextbox.text(), "LinewidthFit.xy", string)        
+        string = self.xystring(np.asarray(self.LinewidthAnalysis[1][0])*1e-9, self.LinewidthAnalysis[1][1], "resonance frequency (GHz), linewidth (T)")
+        self.writedatafile(zf, "LinewidthFit.xy", string)        
         
         # export the report
-        self.writedatafile(self.fileNameTextbox.text(), "Report.log", self.report)        
-
-        # show confirmation message
-        msgBox = QMessageBox()
-        msgBox.setWindowTitle("Export Confirmation")
-        msgBox.setText("Data exported to %s." % self.fileNameTextbox.text())
-        msgBox.setStandardButtons(QMessageBox.Ok)
-        msgBox.exec_()        
+        self.writedatafile(zf, "Report.log", self.report)        
 
 
-        return
-
 class Fit:
     def __init__(self):
-        pass
+        # line shape functions by fit profile name
+        self._profile_fn = {"Lorentz": self.lorentz_derivative,
+                            "Asymmetric Lorentz": self.asymmetric_lorentz_derivative,
+                            "Voigt": self.voigt_derivative}
 
 
     def LineFit(self, dataset, fitProfile):
@@ -461,55 +640,81 @@ class Fit:
 
 
     def calculateFittedLine(self, x, p, fitProfile):
-        x = np.array(x)
-        if fitProfile == "Lorentz":
-            y = self.lorentz_derivative(x, *p)
-        elif fitProfile == "Asymmetric Lorentz":
-            y = self.asymmetric_lorentz_derivative(x, *p)
-        else:            
-            y = self.voigt_derivative(x, *p)
+        # anything else than the Lorentz profiles is a Voigt profile
+        y = self._profile_fn.get(fitProfile, self.voigt_derivative)(x, *p)
         return y
 
 
-    # https://journals.aps.org/prb/pdf/10.1103/PhysRevB.84.054423
     def lorentz_derivative(self, B, A, B0, Gamma, offset):
-        return A * Gamma**2 * (B0 - B) / ((B - B0)**2 + Gamma**2)**2 + offset
-    
-    
+        return _lorentz_derivative(B, A, B0, Gamma, offset)
+
+
+    def lorentz_derivative_jac(self, B, A, B0, Gamma, offset):
+        return _lorentz_derivative_jac(B, A, B0, Gamma, offset)
+
+
     # idea taken from https://www.sciencedirect.com/science/article/pii/S1875389216300906
     def voigt_derivative(self, B, A, B0, Gamma, sigma, offset):
         # Use a Voigt profile to deconvolve homogenous (Lorentzian)
         # and inhomogenous (Gaussian) contributions.
-        # Calculate the derivative for the fit numerically with second-order finite differences.
-        v = A * Gamma**2 * scipy.special.voigt_profile((B-B0), sigma, Gamma)
-        v_diff = np.gradient(v, B, edge_order=2) + offset
-        return v_diff
-    
-    
-    # https://pubs.aip.org/aip/jap/article/117/14/143902/138614/Eddy-current-interactions-in-a-ferromagnet-normal
+        # The Voigt profile is V = Re[w(z)] / (sigma sqrt(2 pi)) with the Faddeeva function
+        # w(z) and z = (B - B0 + i Gamma) / (sigma sqrt(2)). Its field derivative follows
+        # analytically from w'(z) = -2z w(z) + 2i/sqrt(pi), of which only
+        # Re[w'(z)] = -2 (Re z Re w - Im z Im w) is needed.
+        inv_s = 1.0 / (sigma * np.sqrt(2))
+        x = (B - B0) * inv_s
+        y = Gamma * inv_s
+        w = scipy.special.wofz(x + 1j * y)
+        dV_dB = (y * w.imag - x * w.real) * (2 * inv_s**2 / np.sqrt(np.pi))
+        return A * Gamma**2 * dV_dB + offset
+
+
+    def voigt_derivative_jac(self, B, A, B0, Gamma, sigma, offset):
+        # analytical Jacobian of voigt_derivative with respect to (A, B0, Gamma, sigma, offset),
+        # using the second derivative w''(z) = -2 w(z) - 2z w'(z)
+        inv_s = 1.0 / (sigma * np.sqrt(2))
+        z = (B - B0) * inv_s + 1j * (Gamma * inv_s)
+        w = scipy.special.wofz(z)
+        dw = -2 * z * w + 2j / np.sqrt(np.pi)
+        ddw = -2 * w - 2 * z * dw
+        c2 = inv_s**2 / np.sqrt(np.pi)
+        c3 = c2 * inv_s
+        dV_dB = dw.real * c2
+
+        jac = np.empty((B.shape[0], 5))
+        jac[:, 0] = Gamma**2 * dV_dB
+        jac[:, 1] = -A * Gamma**2 * c3 * ddw.real
+        jac[:, 2] = 2 * A * Gamma * dV_dB - A * Gamma**2 * c3 * ddw.imag
+        jac[:, 3] = -A * Gamma**2 * c2 / sigma * ((z * ddw).real + 2 * dw.real)
+        jac[:, 4] = 1.0
+        return jac
+
+
     def asymmetric_lorentz_derivative(self, B, A, B0, Gamma, offset, beta):
-        # asymmetric Lorentz line shape
-        l = A * Gamma**2 * (1 + 2 * beta * (B0 - B)/Gamma) / ((B0 - B)**2 + Gamma**2)
-        l_diff = np.gradient(l, B, edge_order=2) + offset
-        return l_diff
-     
+        return _asymmetric_lorentz_derivative(B, A, B0, Gamma, offset, beta)
+
+
+    def asymmetric_lorentz_derivative_jac(self, B, A, B0, Gamma, offset, beta):
+        return _asymmetric_lorentz_derivative_jac(B, A, B0, Gamma, offset, beta)
+
     
     def fit_derivative(self, x, y, fitProfile):
         # dispersive line shape
     
-        offset = np.mean(y) # quick estimate
+        offset, imin, imax = _yscan(y) # quick estimate
 
         # half-width estimate
-        width = np.abs(x[np.argmax(y)] - x[np.argmin(y)]) / 2 * np.sqrt(3)
+        width = np.abs(x[imax] - x[imin]) / 2 * np.sqrt(3)
         
         
         # check the order of the derivative peaks 
         # then find the position of the peak in the integral
         # and determine the scale
-        integral = scipy.integrate.cumtrapz((y-offset), x)
+        # only the position of the extremum is needed, so a plain running sum will do
+        integral = np.cumsum(y - offset)
         
         # "down-up" profile
-        if np.argmin(y) < np.argmax(y):
+        if imin < imax:
             center = x[np.argmin(integral)]
             scale = y[np.argmin(integral)] - offset
         # "up-down" profile
@@ -530,18 +735,53 @@ class Fit:
         # do the fit with the selected line profile
         if fitProfile == "Lorentz":
             p0 = np.array([scale, center, width, offset])
-            p, pcov = scipy.optimize.curve_fit(self.lorentz_derivative, x, y, p0=p0, bounds=([-np.inf, 0, 0, -np.inf], [np.inf, np.inf, np.inf, np.inf]))
+            p, pcov = self.least_squares_fit(self.lorentz_derivative, self.lorentz_derivative_jac, x, y, p0, \
+                                             bounds=([-np.inf, 0, 0, -np.inf], [np.inf, np.inf, np.inf, np.inf]))
 
         elif fitProfile == "Asymmetric Lorentz":
             p0 = np.array([scale, center, width, offset, 0])
-            p, pcov = scipy.optimize.curve_fit(self.asymmetric_lorentz_derivative, x, y, p0=p0, bounds=([-np.inf, 0, 0, -np.inf, -np.inf], [np.inf, np.inf, np.inf, np.inf, np.inf]))
+            p, pcov = self.least_squares_fit(self.asymmetric_lorentz_derivative, self.asymmetric_lorentz_derivative_jac, x, y, p0, \
+                                             bounds=([-np.inf, 0, 0, -np.inf, -np.inf], [np.inf, np.inf, np.inf, np.inf, np.inf]))
         
         else: # Voigt
             p0 = np.array([scale, center, width, 0.001, offset])
-            p, pcov = scipy.optimize.curve_fit(self.voigt_derivative, x, y, p0=p0, bounds=([-np.inf, 0, 0, 0, -np.inf], [np.inf, np.inf, np.inf, np.inf, np.inf]))
+            p, pcov = self.least_squares_fit(self.voigt_derivative, self.voigt_derivative_jac, x, y, p0, \
+                                             bounds=([-np.inf, 0, 0, 0, -np.inf], [np.inf, np.inf, np.inf, np.inf, np.inf]))
         return p, pcov
     
 
+    def least_squares_fit(self, f, jac, x, y, p0, bounds=None, **kwargs):
+        # fit f(x, *p) to y with the analytical Jacobian jac(x, *p)
+        # x_scale='jac' rescales parameters of very different magnitude (e.g. M and g)
+        # unbounded problems use Levenberg-Marquardt like curve_fit does
+        # NaN or inf in the data raise a ValueError, as in curve_fit
+        x = np.asarray_chkfinite(x, dtype=np.float64)
+        y = np.asarray_chkfinite(y, dtype=np.float64)
+        if bounds is None:
+            method, bounds = 'lm', (-np.inf, np.inf)
+        else:
+            method = 'trf'
+        res = scipy.optimize.least_squares(lambda p: f(x, *p) - y, p0, jac=lambda p: jac(x, *p), \
+                                           bounds=bounds, method=method, x_scale='jac', **kwargs)
+        
+        # covariance from the Jacobian at the solution, computed as in curve_fit,
+        # but with normalized columns so that no parameter drops below the SVD cutoff
+        J = np.asarray(res.jac)
+        norm = np.linalg.norm(J, axis=0)
+        norm[norm == 0] = 1.0
+        _, s, VT = np.linalg.svd(J / norm, full_matrices=False)
+        threshold = np.finfo(float).eps * max(J.shape) * s[0]
+        s = s[s > threshold]
+        VT = VT[:s.size]
+        pcov = np.dot(VT.T / s**2, VT) / np.outer(norm, norm)
+        dof = y.size - res.x.size
+        if dof > 0:
+            pcov *= 2 * res.cost / dof
+        else:
+            pcov.fill(np.inf)
+        return res.x, pcov
+    
+
     def KittelFit(self, x, y, mode):
         # Extract data for Kittel fit
         resonance_fields = x
@@ -552,35 +792,53 @@ class Fit:
         
         if mode == "in-plane":
             p0 = [1000e3, 2.1]  
-            p, pcov = scipy.optimize.curve_fit(self.kittel_fitfunction_inplane, resonance_fields, resonance_frequencies, p0=p0)
+            p, pcov = self.least_squares_fit(self.kittel_fitfunction_inplane, self.kittel_fitfunction_inplane_jac, resonance_fields, resonance_frequencies, p0)
             y_fit = self.kittel_fitfunction_inplane(x_fit, *p)
 
         elif mode == "out-of-plane":
             # initial guess for M
-            gamma_prime = 2.1*e/(2*me) / (2*np.pi)
-            M = 1/mu0 * np.mean( np.array(resonance_fields) - np.array(resonance_frequencies)*1e9 / gamma_prime)
+            gamma_prime = 2.1*K_GAMMA
+            M = 1/mu0 * np.mean( np.asarray(resonance_fields) - np.asarray(resonance_frequencies)*1e9 / gamma_prime)
             p0 = [M, 2.1]
-            p, pcov = scipy.optimize.curve_fit(self.kittel_fitfunction_outofplane, resonance_fields, resonance_frequencies, p0=p0)
+            p, pcov = self.least_squares_fit(self.kittel_fitfunction_outofplane, self.kittel_fitfunction_outofplane_jac, resonance_fields, resonance_frequencies, p0)
             y_fit = self.kittel_fitfunction_outofplane(x_fit, *p)
 
         return x_fit, y_fit, p, pcov
 
 
     def kittel_fitfunction_inplane(self, B, M, g):
-        gamma_prime = g*e/(2*me) / (2*np.pi)
+        gamma_prime = g*K_GAMMA
         return gamma_prime * np.sqrt((B) * (B + mu0 * M))
 
 
+    def kittel_fitfunction_inplane_jac(self, B, M, g):
+        # analytical Jacobian with respect to (M, g)
+        root = np.sqrt((B) * (B + mu0 * M))
+        jac = np.empty((B.shape[0], 2))
+        jac[:, 0] = g*K_GAMMA * mu0 * B / (2 * root)
+        jac[:, 1] = K_GAMMA * root
+        return jac
+
+
     def kittel_fitfunction_outofplane(self, B, M, g):
-        gamma_prime = g*e/(2*me) / (2*np.pi)
+        gamma_prime = g*K_GAMMA
         return gamma_prime * (B - mu0 * M)
+
+
+    def kittel_fitfunction_outofplane_jac(self, B, M, g):
+        # analytical Jacobian with respect to (M, g)
+        jac = np.empty((B.shape[0], 2))
+        jac[:, 0] = -g*K_GAMMA * mu0
+        jac[:, 1] = K_GAMMA * (B - mu0 * M)
+        return jac
     
     
     def DampingFit(self, frequencies, widths, gamma_prime):
-        damping_fitfunction_curry = lambda f, alpha, deltaB0: self.damping_fitfunction(f, alpha, deltaB0, gamma_prime)
+        damping_fitfunction_curry = functools.partial(_damping, gamma_prime=gamma_prime)
+        damping_jac_curry = functools.partial(_damping_jac, gamma_prime=gamma_prime)
         
         p0 = [0.005, 0.0]
-        p, pcov = scipy.optimize.curve_fit(damping_fitfunction_curry, frequencies, widths, p0=p0)
+        p, pcov = self.least_squares_fit(damping_fitfunction_curry, damping_jac_curry, frequencies, widths, p0)
         x_fit = np.linspace(0, max(frequencies), 100)
         y_fit = damping_fitfunction_curry(x_fit, *p)
         
@@ -588,7 +846,7 @@ class Fit:
     
     
     def damping_fitfunction(self, f, alpha, deltaB0, gamma_prime):
-        return alpha * f / gamma_prime + deltaB0
+        return _damping(f, alpha, deltaB0, gamma_prime)
     
     
 def main():
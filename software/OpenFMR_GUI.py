@@ -18,33 +18,81 @@
 
 import sys
 import os
+import io
 #import time
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import pyqtSignal, QObject, Qt
+from PyQt5.QtCore import pyqtSignal, QObject, Qt, QTimer
 
 from PyQt5.QtGui import QTextCursor
 import threading
+import contextlib
+import importlib
+import importlib.util
+import traceback
 
 import pyqtgraph as pg
+import numpy as np
 
 import zipfile
+import re
+
+import fmr
 
 
 
 
 # streaming class for live update of the message window
+# write() is called from the measurement thread and only collects the text,
+# a timer in the GUI thread emits the collected text as one block
 class Stream(QObject):
     newText = pyqtSignal(str)
 
+    def __init__(self, interval=50):
+        super().__init__()
+        self._buf = []
+        self._log = io.StringIO()  # everything written since the last reset, for the log file
+        self._lock = threading.Lock()
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._emit_buffer)
+        self._timer.start()
+
     def write(self, text):
-        self.newText.emit(str(text))
+        text = str(text)
+        with self._lock:
+            self._buf.append(text)
+            self._log.write(text)
 
     def flush(self):
-        pass
+        self._emit_buffer()
+
+    def _emit_buffer(self):
+        with self._lock:
+            if not self._buf:
+                return
+            text = "".join(self._buf)
+            self._buf = []
+        self.newText.emit(text)
+
+    def getlog(self):
+        # carriage returns start a new line, as they do in the message window
+        with self._lock:
+            return self._log.getvalue().replace("\r", "\n")
+
+    def reset(self):
+        with self._lock:
+            self._buf = []
+            self._log = io.StringIO()
 
 
 
 class MainApp(QtWidgets.QMainWindow):
+    
+    # emitted from the measurement thread when a measurement has ended
+    measurementFinished = pyqtSignal()
+    
+    # field, X and Y of a data line "<> Field: ... T  | X: ... V | Y: ... V | Progress: ...% </>"
+    _LINE_RE = re.compile(r"<>\s*Field:\s*(\S+)\s*T\s*\|\s*X:\s*(\S+)\s*V\s*\|\s*Y:\s*(\S+)\s*V")
         
     def __init__(self):
         super().__init__()
@@ -67,20 +115,24 @@ Note II: For PMA samples, Meff is negative."
         self.initUI()
 
 
-        # Original stdout
-        self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
-
         # Redirect stdout
         self.stream = Stream()
         self.stream.newText.connect(self.on_new_text)
         
         self.fmr = None
         
+        # the measurement runs in a daemon worker thread, one at a time,
+        # so that a measurement which does not stop cannot block the exit
+        self._thread = None
+        self.measurementFinished.connect(self.on_finished)
+        
         self.stop_button.setEnabled(False)
         
-        self.livedata = [[],[],[]]
+        # live data (field, X, Y) of the current sweep, the first _n columns are valid
+        self._alloc_buffers(1024)
         
+        # incomplete last line of the text received so far
+        self._line_buf = ""
                 
 
     def initUI(self):
@@ -97,19 +149,42 @@ Note II: For PMA samples, Meff is negative."
         graphs_layout = QtWidgets.QVBoxLayout()  # Vertical layout for graphs and message window
 
         # Main Plot Window
+        # draw the curves with OpenGL if PyOpenGL is available, otherwise keep the raster backend
+        if importlib.util.find_spec("OpenGL") is not None:
+            pg.setConfigOptions(useOpenGL=True, enableExperimental=True, antialias=False)
         self.plot_window = pg.PlotWidget()
         self.setup_plot_style(self.plot_window)
         self.plot_window.setLabel('bottom', 'Field', units='T')
         self.plot_window.setLabel('left', 'Lock-In signals', units='V')
 
+        # persistent curves, updated with setData
+        self.curve_r = self.plot_window.plot(pen=pg.mkPen('r', width=1))
+        self.curve_b = self.plot_window.plot(pen=pg.mkPen('b', width=1))
+        for curve in (self.curve_r, self.curve_b):
+            # draw only the visible part, reduced to about one point per pixel
+            curve.setDownsampling(auto=True, method='peak')
+            curve.setClipToView(True)
+
+        # redraw at most every 33 ms (30 Hz), independent of the data rate
+        self._dirty = False
+        self._plot_timer = QTimer(self)
+        self._plot_timer.setInterval(33)
+        self._plot_timer.timeout.connect(self._flush_plot)
+        self._plot_timer.start()
+
         graphs_layout.addWidget(self.plot_window)
 
         
         # Message window
         message_layout = QtWidgets.QHBoxLayout()  
 
-        self.message_window = QtWidgets.QTextEdit(self)
+        # append-only plain text log with a bounded history, the full log is kept by the stream
+        self.message_window = QtWidgets.QPlainTextEdit(self)
         self.message_window.setReadOnly(True)
+        self.message_window.setUndoRedoEnabled(False)
+        self.message_window.setMaximumBlockCount(5000)
+        # one cursor on the document for all inserts, independent of the view's cursor
+        self._cursor = QTextCursor(self.message_window.document())
         message_layout.addWidget(self.message_window)
         
         
@@ -242,8 +317,13 @@ Note II: For PMA samples, Meff is negative."
         self.accuracy_combobox = QtWidgets.QComboBox(self)
         self.accuracy_combobox.addItems(["low", "medium", "high"])
 
+        # reimport the fmr module on start to help making quick changes to the
+        # script without restarting the GUI
+        self.dev_reload_checkbox = QtWidgets.QCheckBox("Reload fmr module", self)
+
         accuracy_layout.addWidget(self.accuracy_label)
         accuracy_layout.addWidget(self.accuracy_combobox)
+        accuracy_layout.addWidget(self.dev_reload_checkbox)
         frame_layout.addLayout(accuracy_layout)
 
 
@@ -263,9 +343,11 @@ Note II: For PMA samples, Meff is negative."
         # Info frame
         self.info_frame = QtWidgets.QGroupBox("Information")
         info_layout = QtWidgets.QVBoxLayout()
-        self.info_label = QtWidgets.QLabel(self.infotext)
+        # read-only text view, laid out once instead of re-wrapped like a QLabel on every resize
+        self.info_label = QtWidgets.QTextBrowser()
+        self.info_label.setPlainText(self.infotext)
         self.info_label.setFixedWidth(550)
-        self.info_label.setWordWrap(True)
+        self.info_label.setFrameShape(QtWidgets.QFrame.NoFrame)
         info_layout.addWidget(self.info_label)
         
         
@@ -291,11 +373,11 @@ Note II: For PMA samples, Meff is negative."
 
 
     def append_message(self, message):
-        self.message_window.append(message)
+        self.message_window.appendPlainText(message)
 
     def initialize_device(self):
         self.device_controls.initialize()
-        self.message_window.append("Device initialized.")
+        self.message_window.appendPlainText("Device initialized.")
 
 
     def stop_measurement(self):
@@ -312,10 +394,17 @@ Note II: For PMA samples, Meff is negative."
         plot_widget.getAxis('bottom').setTextPen('k') # Black color
 
 
-    def update_plot(self, data):
+    def update_plot(self):
         # For now, just plotting the 'Signal' against 'Field'
-        self.plot_window.plot(data[0], data[1], clear=True, pen=pg.mkPen('r', width=1))
-        self.plot_window.plot(data[0], data[2], pen=pg.mkPen('b', width=1))
+        n = self._n
+        self.curve_r.setData(self.livedata[0, :n], self.livedata[1, :n])
+        self.curve_b.setData(self.livedata[0, :n], self.livedata[2, :n])
+
+
+    def _flush_plot(self):
+        if self._dirty:
+            self._dirty = False
+            self.update_plot()
 
 
     def select_folder(self):
@@ -336,29 +425,60 @@ Note II: For PMA samples, Meff is negative."
 
 
 
+    def _alloc_buffers(self, n):
+        # single precision is plenty for the display
+        self.livedata = np.empty((3, n), dtype=np.float32)
+        self._n = 0
+
+
+    def sweep_points(self, accuracy):
+        # upper bound of the points per field sweep, from the sampling in fmr.FMR.field_sweep
+        multiplier, sampling = {"low": (12, 4), "medium": (8, 6), "high": (6, 8)}[accuracy]
+        return 2 * multiplier * sampling + 2
+
+
     def parse_data(self, line):
-        p = line.split("|")
-        v1 = float(p[0].split()[2])
-        v2 = float(p[1].split()[1])
-        v3 = float(p[2].split()[1])
-        self.livedata[0].append(v1)
-        self.livedata[1].append(v2)
-        self.livedata[2].append(v3)
+        m = self._LINE_RE.match(line)
+        if m is None:
+            return
+        v1, v2, v3 = map(float, m.groups())
+        # grow the buffer if a sweep has more points than expected
+        if self._n == self.livedata.shape[1]:
+            self.livedata = np.concatenate((self.livedata, np.empty_like(self.livedata)), axis=1)
+        self.livedata[:, self._n] = (v1, v2, v3)
+        self._n += 1
+        self._dirty = True
 
 
     def on_new_text(self, text):
-        self.message_window.moveCursor(QTextCursor.End)
-        self.message_window.insertPlainText(text)
+        self._cursor.movePosition(QTextCursor.End)
+        self._cursor.insertText(text)
+        scrollbar = self.message_window.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
         
-        message_window_current_text = str(self.message_window.toPlainText())
-        lines = message_window_current_text.splitlines()
-
-        if lines[-1].startswith("<>") and lines[-1].endswith("</>"):
-            self.parse_data(lines[-1])
-            self.update_plot(self.livedata)
+        # plain messages without any data or measurement markers need no parsing
+        if not self._line_buf and "<" not in text:
+            return
+        
+        # the text is a block of several writes, so it may contain many data lines;
+        # only the new text is split, an incomplete last line is kept for the next block
+        # (data lines are printed without a line break, but always in a single write)
+        self._line_buf += text
+        lines = self._line_buf.splitlines()
+        self._line_buf = ""
+        if lines and not text.endswith(("\n", "\r")) and not lines[-1].endswith("</>"):
+            self._line_buf = lines.pop()
+
+        for line in lines:
+            if not line.startswith("<"):
+                continue
             
-        if lines[-1] == "<NEW_MEASUREMENT>":
-            self.livedata = [[],[],[]]
+            if line.startswith("<>") and line.endswith("</>"):
+                self.parse_data(line)
+                
+            elif line == "<NEW_MEASUREMENT>":
+                self._n = 0
+                self._dirty = True
 
                     
         
@@ -377,22 +497,43 @@ Note II: For PMA samples, Meff is negative."
         self.start_button.setEnabled(False)
         self.stop_button.setEnabled(True)
 
-        self.livedata = [[],[],[]]
+        self._alloc_buffers(self.sweep_points(self.accuracy_combobox.currentText()))
+        self._dirty = True
+        self._line_buf = ""
 
         self.message_window.clear()     
+        self.stream.reset()
 
-        threading.Thread(target=self.run_script, daemon=True).start()
+        self._thread = threading.Thread(target=self.run_script, daemon=True)
+        self._thread.start()
         
  
         
         
     def on_stop(self):
+        # Start is enabled again by on_finished, once the run has ramped down and closed the instruments
         if self.fmr:
             self.fmr.stop()
-            self.start_button.setEnabled(True)
             self.stop_button.setEnabled(False)
             
 
+    def closeEvent(self, event):
+        # stop a running measurement and give it a few seconds to ramp down,
+        # a daemon thread that is still running does not keep the process alive
+        if self.fmr:
+            self.fmr.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        super().closeEvent(event)
+
+
+    def on_finished(self):
+        # Reset start/stop buttons, in the GUI thread
+        self.start_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+
+
+
     def run_script(self):
 
         # get parameters from the GUI
@@ -422,6 +563,7 @@ Note II: For PMA samples, Meff is negative."
         
 
         accuracy = self.accuracy_combobox.currentText()
+        reload_fmr = self.dev_reload_checkbox.isChecked()
         
         path = foldername + "/" + zipfilename
 
@@ -443,42 +585,40 @@ Note II: For PMA samples, Meff is negative."
         
         self.stream.write(parameters)
         
-        # Redirect stdout and stderr to the stream
-        sys.stdout = self.stream
-        sys.stderr = self.stream
-        
-        
-        # real measurement starts here
-        
-        # reimport fmr_classes module to help making quick changes to the
-        # script without restarting the GUI
-        import fmr
-        self.fmr = fmr.FMR()
-
-        # run the measurement
-        self.fmr.fmr_measurement(path, Meff, alpha, g, deltaB0, magnet=magnet, mode=mode, accuracy=accuracy, delay=delay, \
-                modulation_field_rms=modulation_field_rms, lowpass=lowpass, \
-                    freqmin=freqmin, freqstep=freqstep, freqmax=freqmax, GUI=True)
-
-        
-        # Reset stdout and stderr
-        sys.stdout = self.original_stdout
-        sys.stderr = self.original_stderr
-        
-        # Reset start/stop buttons
-        self.start_button.setEnabled(True)
-        self.stop_button.setEnabled(False)
-        
-        # write the log
-        log = str(self.message_window.toPlainText())
-        self.writedatafile(path+".zip", "logfile.log", log)  
+        # Redirect stdout and stderr to the stream, they are restored
+        # even if the measurement fails
+        try:
+            with contextlib.redirect_stdout(self.stream), contextlib.redirect_stderr(self.stream):
+                try:
+                    # real measurement starts here
+                    
+                    if reload_fmr:
+                        importlib.reload(fmr)
+                    self.fmr = fmr.FMR()
+            
+                    # run the measurement
+                    self.fmr.fmr_measurement(path, Meff, alpha, g, deltaB0, magnet=magnet, mode=mode, accuracy=accuracy, delay=delay, \
+                            modulation_field_rms=modulation_field_rms, lowpass=lowpass, \
+                                freqmin=freqmin, freqstep=freqstep, freqmax=freqmax, GUI=True)
+                except Exception:
+                    # show the error in the message window, it also goes into the log
+                    traceback.print_exc()
+            
+            # write the log, taken from the stream as the message window may lag behind
+            log = self.stream.getlog()
+            self.writedatafile(path+".zip", "logfile.log", log)  
+        finally:
+            # Reset start/stop buttons
+            self.measurementFinished.emit()
 
 
             
     def writedatafile(self, zipfilename, filename, string):
-        zf = zipfile.ZipFile(zipfilename, mode="a")    
-        zf.writestr(filename, string)
-        zf.close()
+        # compressed, written in 64 kB pieces to avoid one large encoded copy of the log
+        with zipfile.ZipFile(zipfilename, mode="a", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            with zf.open(filename, "w", force_zip64=True) as f:
+                for i in range(0, len(string), 65536):
+                    f.write(string[i:i+65536].encode("utf-8"))
         
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@
 """
 
 import time
+import sys
 import serial
 import socket
 import re
@@ -25,9 +26,64 @@ import os
 import zhinst.ziPython as ziPython
 import zhinst.utils as ut
 import math
+import bisect
+import concurrent.futures
+import numpy as np
 
+
+# numbers in instrument replies, used when a reply is not a plain float
+_FLOAT_RE = re.compile(r'-?\d+\.?\d*')
+
+# measurement ranges of the FH55 teslameter in T (sorted) and their range codes
+_RANGE_THRESHOLDS = (3e-3, 30e-3, 300e-3, 3)
+_RANGE_CODES = (3, 4, 5, 6)
+
+# idle CaenelsFastPS connections by (ip, port), left by close(disconnect=False)
+# and taken over by a later initialize()
+_CONN_POOL = {}
+
+# limits of the CaenelsFastPS models
+_MODEL_SPECS = {
+    2040: {'max_current': 20.0, 'max_voltage': 40.0, 'max_slewRateCurrent': 200.0,
+           'max_slewRateVoltage': 400.0, 'time_to_wait_in_s': 0.01},
+    3050: {'max_current': 30.0, 'max_voltage': 50.0, 'max_slewRateCurrent': 200.0,
+           'max_slewRateVoltage': 400.0, 'time_to_wait_in_s': 0.01},
+}
+
+# acknowledge/not acknowledge of the CaenelsFastPS, after the leading #
+_AK = 'AK'
+_NAK = 'NAK'
+
+# fixed CaenelsFastPS commands, encoded once
+_CMD_MRV = b'MRV\r'
+_CMD_MRI = b'MRI\r'
+_CMD_MOFF = b'MOFF\r'
+_CMD_MON = b'MON\r'
+
+# valid arguments of the MFLI setters
+_CHANNELS = frozenset((0, 1, 2, 3))  # demodulators, oscillators and aux outputs
+_ORDERS = frozenset(range(1, 9))
+_SWITCH = frozenset((0, 1))
+_UNITS = frozenset(('Vrms', 'Vpk'))
+
+# demodulator samples as returned by MFLI.getDemodSample
+_SAMPLE_DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('t', 'u8')])
+
+
+def _sample_array(sample):
+    # ziDAQ sample dict to a structured array, oldest sample first
+    arr = np.empty(len(sample['x']), dtype=_SAMPLE_DTYPE)
+    arr['x'] = sample['x']
+    arr['y'] = sample['y']
+    arr['t'] = sample['timestamp']
+    return arr
         
 class SG30000PRO:
+    # query commands
+    _Q_FREQ = b'FREQ:CW?\n'
+    _Q_POW = b'POWER?\n'
+    _Q_OUT = b'OUTP:STAT?\n'
+    
     def __init__(self):
         self.deviceport = None
         self.device = None
@@ -44,64 +100,93 @@ class SG30000PRO:
         self.delay_short = 0.01
         self.delay_long = 0.2
         self.deviceport = port
-        self.device = serial.Serial("COM8", 115200, timeout=1)
+        self.device = serial.Serial(port, 115200, timeout=1)
+        # cut the latency timer of USB serial adapters (only available on Linux)
+        if hasattr(self.device, 'set_low_latency_mode'):
+            try: self.device.set_low_latency_mode(True)
+            except (OSError, ValueError): pass
     
     def reset(self):
-        print("Resetting the SG30000PRO generator. This takes approximately 10s.")
+        print("Resetting the SG30000PRO generator. This takes up to 10s.")
         self.device.write(b'*RST\n')
-        time.sleep(10)
-        _ = self.device.readline()
-        self.freq = self.get_frequency()
-        self.power = self.get_power()
-        self.output = self.get_output()
+        # poll until the generator answers a query again, at most 12 s
+        deadline = time.monotonic() + 12
+        while time.monotonic() < deadline:
+            time.sleep(0.2)
+            self.device.reset_input_buffer()
+            self.device.write(self._Q_FREQ)
+            response = self.device.readline()
+            if response.endswith(b'HZ\r\n'):
+                break
+        self.freq = self.get_frequency(force=True)
+        self.power = self.get_power(force=True)
+        self.output = self.get_output(force=True)
     
     def close(self):
         self.set_output(0)
         self.device.close()
         
-    def get_frequency(self):
-        self.device.write(b'FREQ:CW?\n')
-        time.sleep(self.delay_short)
+    # the getters return the value set last, force=True reads it from the generator
+    def get_frequency(self, force=False):
+        if not force and self.freq is not None:
+            return self.freq
+        self.device.write(self._Q_FREQ)
+        # readline blocks until the reply is complete
         response = self.device.readline() 
         if response == self.badCommandResponse:
             return ValueError('Command failed.')
         freq = int(response.decode().replace('HZ\r\n', ''))
+        self.freq = freq
         return freq
     
     def set_frequency(self, freq):
         # supply the frequency in Hz!
-        # convert to MHz
-        freq = int(freq * 1e-6)
-        self.device.write(b'FREQ:CW %iMHZ\n' % freq)
-        time.sleep(self.delay_short)
+        # convert to MHz, the serial link keeps the commands in order, no need to wait
+        freq = int(freq) // 1000000
+        self.device.write(b'FREQ:CW %dMHZ\n' % freq)
+        self.freq = freq * 1000000
+    
+    def wait_settled(self, settle=0.005):
+        # the generator has no *OPC?, but it answers a query only after the commands before it
+        # are done, then give the synthesizer a moment to lock
+        self.get_frequency(force=True)
+        time.sleep(settle)
   
         
-    def get_power(self):
-        self.device.write(b'POWER?\n')
-        time.sleep(self.delay_short)
+    def get_power(self, force=False):
+        if not force and self.power is not None:
+            return self.power
+        self.device.write(self._Q_POW)
+        # readline blocks until the reply is complete
         response = self.device.readline() 
         if response == self.badCommandResponse:
             return ValueError('Command failed.')
         
         power = float(response.decode().replace('dBm\r\n', ''))
+        self.power = power
         return power  
 
     def set_power(self, power):
         # supply the frequency in dBm
         self.device.write(b'POWER %.2f\n' % power)
+        self.power = round(power, 2)
         time.sleep(self.delay_long)
         
-    def get_output(self):
-        self.device.write(b'OUTP:STAT?\n')
-        time.sleep(self.delay_short)
+    def get_output(self, force=False):
+        if not force and self.output is not None:
+            return self.output
+        self.device.write(self._Q_OUT)
+        # readline blocks until the reply is complete
         response = self.device.readline() 
         if response == self.badCommandResponse:
             return ValueError('Command failed.')
         
         output = response.decode().replace('\r\n', '')
         if output == "OFF":
+            self.output = 0
             return 0
         elif output == "ON":
+            self.output = 1
             return 1
         else:
             return ValueError("Output error.")
@@ -113,6 +198,7 @@ class SG30000PRO:
             self.device.write(b'OUTP:STAT ON\n')
         else:
             return ValueError("Output value must be 0 (off) or 1 (on).")
+        self.output = output
         time.sleep(self.delay_long)
         
     def set_buzzer(self, status):
@@ -135,6 +221,9 @@ class SG30000PRO:
         
         
 class Keithley6500:
+    # command prefix for each supported measurement function
+    _PREFIX = {func: 'SENSe:%s:' % func for func in ("VOLT:DC", "VOLT:AC", "CURR:DC", "CURR:AC", "RES")}
+
     def __init__(self):
         self.deviceport = None
         self.device = None
@@ -144,6 +233,16 @@ class Keithley6500:
         self.delay = None
         self.function = None
         self.rangE = None
+        self.count = None
+        # all settings of the last get_measurement call
+        self._cfg_key = None
+        # receive buffer, may hold the start of the next reply
+        self._rxbuf = bytearray(4096)
+        self._rxmv = memoryview(self._rxbuf)
+        self._rxlen = 0
+        # readings as IEEE-754 doubles instead of ASCII, set to False before initialize()
+        # for plain ASCII replies (debugging)
+        self.binary = True
         
     def initialize(self, ip, port):
         """
@@ -164,10 +263,12 @@ class Keithley6500:
         self.max_nplc = 12.
         self.min_nplc = 1e-4
         try:
-            self.device = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_address = (ip, port)
-            self.device.connect(server_address)
-            self.device.settimeout(1)
+            self.device = socket.create_connection(server_address, timeout=1)
+            # send the short SCPI commands immediately instead of waiting for the ACK of the previous one
+            self.device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # the connection stays open for a whole measurement, notice a dead link
+            self.device.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.reset('all')
         except: print(__class__.__name__,'.initialize(), problem with connecting')
 
@@ -177,13 +278,20 @@ class Keithley6500:
             if option == 'all': option = ["device","variables"]
             if 'device' in option: 
                 self.__send('*RST')
-                self.__send(':FORMat:ASCii:PRECision MAX')
+                if self.binary:
+                    self.__send(':FORMat:DATA REAL')
+                    self.__send(':FORMat:BORDer SWAPped')
+                else:
+                    self.__send(':FORMat:ASCii:PRECision MAX')
+                self.__sync()
             if 'variables' in option:
                 self.nplc = None
                 self.filterCount = None
                 self.delay = None
                 self.function = None
                 self.rangE = None
+                self.count = None
+                self._cfg_key = None
         except ValueError as e: print(__class__.__name__,'.reset(), invalid input param, ',e)
         except: print(__class__.__name__,'.reset(), problems resetting the device')
             
@@ -197,10 +305,19 @@ class Keithley6500:
     def __send(self, string):
         try:
             s = string + "\n"
-            self.device.send(s.encode())
-            time.sleep(self.time_to_wait_in_s)
+            self.device.sendall(s.encode())
         except: print(__class__.__name__,'.__send(), problem with sending the command '+s)
 
+    def __sync(self):
+        # queries synchronize through their reply, plain settings wait for *OPC?
+        self.__send('*OPC?')
+        self.__read()
+
+    def __send_batch(self, cmds):
+        # several commands in one line, each one starting from the root of the command tree
+        # (common commands like *WAI have no root)
+        self.__send(';'.join(cmd if cmd.startswith('*') else ':' + cmd.lstrip(':') for cmd in cmds))
+
     def get_measurement(self, function,expectedValue, nplc=0.1, filterCount=0, filterFunction='REP', delay = 'ON', autozero = 'ON'):
         """ This method returns a measurement, one shot\n
 
@@ -232,49 +349,128 @@ class Keithley6500:
 
         """
         try:
-            if (filterFunction not in ['REP', 'MOV', 'HYBR']): raise ValueError('filterFunction must be MOV, HYBR or REP')
-            if (function not in ["VOLT:DC","VOLT:AC","CURR:DC", "CURR:AC", "RES"]): raise ValueError('ACDC must be "AC" or "DC"')
-            if (function[-2:]!="AC"):
-                if (float(nplc)<self.min_nplc) or (float(nplc)>self.max_nplc): raise ValueError('nplc must be in range 1e-4 .. 12"')
-            if delay not in ["OFF","ON"]: raise ValueError('delay must be ON or OFF')
+            # same settings as last time, just read
+            key = (function, nplc, int(filterCount), filterFunction, delay, autozero, expectedValue)
+            if key == self._cfg_key and self.count == 1:
+                return self.__scan()
             
-            if (self.function != function):
-                self.reset('variables')# If the function doesnt match, all variables have to be set again
-                self.function = function
-                self.__send('SENSe:FUNCtion "{func}"'.format(func=function))
-            if (self.nplc != nplc) and (function[-2:]!="AC"):
-                self.__send('SENSe:{func}:NPLCycles {npl}'.format(func=function, npl=nplc))
-                self.nplc = nplc
-            if self.filterCount != int(filterCount):
-                if int(filterCount) == 0:
-                    self.__send('SENSe:{func}:AVERage OFF'.format(func=function))
-                elif int(filterCount) != 0:
-                    self.__send('SENSe:{func}:AVER:COUNT {nbr}'.format(func=function,nbr=filterCount))
-                    self.__send('SENSe:{func}:AVER:TCON {filterfunc}'.format(func=function, filterfunc=filterFunction)) #TCON MOV REP
-                    self.__send('SENSe:{func}:AVER ON'.format(func=function))
-                    if (function[-2:]!="AC"):
-                        self.__send('SENSe:{func}:AZER {Azer}'.format(func=function, Azer=autozero))
-                self.filterCount = filterCount
-            if self.delay != delay:
-                self.delay = delay
-                self.__send('SENSe:{func}:DELay:AUTO {dela}'.format(func=function,dela=delay))
-            if self.rangE != expectedValue:
-                self.rangE = expectedValue
-                self.__send('SENSe:{func}:RANGe {rang}'.format(func=function,rang=expectedValue))
-            self.i = 5 #try 3 times to read data
-            return self.__scan()
+            # the changed settings are sent together with the READ? query
+            return self.__scan(self.__single(key))
         except ValueError as e: print(__class__.__name__,'.get_measurement(), invalid input param, ',e)
         except: print(__class__.__name__,'.get_measurement(), problem with reading the voltage')
     
+    def configure(self, function, expectedValue, nplc=0.1, filterCount=0, filterFunction='REP', delay = 'ON', autozero = 'ON'):
+        """ This method sets up a single reading once, read() then only triggers it\n
+
+        Parameters
+        ----------\n
+        as in get_measurement
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            key = (function, nplc, int(filterCount), filterFunction, delay, autozero, expectedValue)
+            cmds = self.__single(key)
+            if cmds:
+                self.__send_batch(cmds)
+                self.__sync()
+        except ValueError as e: print(__class__.__name__,'.configure(), invalid input param, ',e)
+        except Exception as e: print(__class__.__name__,'.configure(), problem with the settings ',e)
+    
+    def read(self):
+        # one reading with the settings of the last configure() or get_measurement()
+        return self.__scan()
+    
+    def __single(self, key):
+        # commands for a single reading with the settings in key
+        function, nplc, filterCount, filterFunction, delay, autozero, expectedValue = key
+        cmds = [] if key == self._cfg_key else self.__settings(function, expectedValue, nplc, filterCount, filterFunction, delay, autozero)
+        self._cfg_key = key
+        if self.count != 1:
+            cmds.append('SENSe:COUNt 1')
+            self.count = 1
+        return cmds
+    
+    def get_measurement_buffer(self, function, expectedValue, n, nplc=1, delay = 'ON', autozero = 'ON'):
+        """ This method returns n measurements, taken in one burst and read back together\n
+
+        Parameters
+        ----------\n
+        function, expectedValue, nplc, delay, autozero : as in get_measurement, the filter is off
+        n : int
+            number of readings
+        Returns
+        -------
+        numpy array
+            the n readings.
+
+        """
+        try:
+            n = int(n)
+            if n < 1: raise ValueError('n must be at least 1')
+            key = (function, nplc, 0, 'REP', delay, autozero, expectedValue)
+            cmds = [] if key == self._cfg_key else self.__settings(function, expectedValue, nplc, 0, 'REP', delay, autozero)
+            self._cfg_key = key
+            if self.count != n:
+                cmds.append('SENSe:COUNt %d' % n)
+                self.count = n
+            # fill the default buffer with n readings, then read them all at once
+            cmds += ['TRACe:CLEar', 'TRACe:TRIGger "defbuffer1"', '*WAI', 'TRACe:DATA? 1, %d, "defbuffer1", READ' % n]
+            self.__send_batch(cmds)
+            if self.binary:
+                return np.atleast_1d(self.__read_block(n))
+            response = self.__read()
+            if not response: raise Exception('no reply from the device')
+            return np.array(response.split(b','), dtype=float)
+        except ValueError as e: print(__class__.__name__,'.get_measurement_buffer(), invalid input param, ',e)
+        except Exception as e: print(__class__.__name__,'.get_measurement_buffer(), problem with reading the buffer ',e)
+    
+    def __settings(self, function, expectedValue, nplc, filterCount, filterFunction, delay, autozero):
+        # checks the settings and returns the commands for the changed ones
+        if (filterFunction not in ['REP', 'MOV', 'HYBR']): raise ValueError('filterFunction must be MOV, HYBR or REP')
+        if (function not in self._PREFIX): raise ValueError('ACDC must be "AC" or "DC"')
+        if (function[-2:]!="AC"):
+            if (float(nplc)<self.min_nplc) or (float(nplc)>self.max_nplc): raise ValueError('nplc must be in range 1e-4 .. 12"')
+        if delay not in ["OFF","ON"]: raise ValueError('delay must be ON or OFF')
+        
+        cmds = []
+        prefix = self._PREFIX[function]
+        if (self.function != function):
+            self.reset('variables')# If the function doesnt match, all variables have to be set again
+            self.function = function
+            cmds.append('SENSe:FUNCtion "%s"' % function)
+        if (self.nplc != nplc) and (function[-2:]!="AC"):
+            cmds.append(prefix + 'NPLCycles %s' % nplc)
+            self.nplc = nplc
+        if self.filterCount != int(filterCount):
+            if int(filterCount) == 0:
+                cmds.append(prefix + 'AVERage OFF')
+            elif int(filterCount) != 0:
+                cmds.append(prefix + 'AVER:COUNT %s' % filterCount)
+                cmds.append(prefix + 'AVER:TCON %s' % filterFunction) #TCON MOV REP
+                cmds.append(prefix + 'AVER ON')
+                if (function[-2:]!="AC"):
+                    cmds.append(prefix + 'AZER %s' % autozero)
+            self.filterCount = filterCount
+        if self.delay != delay:
+            self.delay = delay
+            cmds.append(prefix + 'DELay:AUTO %s' % delay)
+        if self.rangE != expectedValue:
+            self.rangE = expectedValue
+            cmds.append(prefix + 'RANGe %s' % expectedValue)
+        return cmds
+    
         
       
-    def __scan(self):
+    def __scan(self, cmds=()):
         try:
-            self.__send(':READ?')
-            if(self.nplc>1.):
-                response = self.__read(self.nplc*.02+0.05)
-            else:
-                response = self.__read(self.nplc*(self.time_to_wait_in_s))
+            self.__send_batch(list(cmds) + [':READ?'])
+            if self.binary:
+                return self.__read_block()
+            response = self.__read()
+            if not response: raise Exception('no reply from the device')
             
             #print('Hier bin ich',str(response))
             response = response.decode()
@@ -284,17 +480,58 @@ class Keithley6500:
         except Exception as e: 
             print(__class__.__name__,'.__scan(), problem with scanning ',e)
             
-    def __read(self, t_wait):
-        try:
-            self.i = self.i-1
-            response = self.device.recv(1024)
-            time.sleep(t_wait)
-            if response is not None: 
-                #print('abc ',response)
-                return response
-        except:
-            if (self.i > 0): 
-                self.__read(t_wait)
+    def __read(self, retries=3):
+        # read up to the terminating newline, returns b'' if nothing came
+        while True:
+            end = self._rxbuf.find(b'\n', 0, self._rxlen)
+            if end >= 0:
+                return self.__take(end+1)
+            if not self.__fill(retries): return b''
+            
+    def __read_exact(self, n, retries=3):
+        while self._rxlen < n:
+            if not self.__fill(retries): return b''
+        return self.__take(n)
+    
+    def __read_block(self, n=1):
+        # binary reply: #<digits><length><doubles>, the Keithley sends the open-length
+        # header #0 (no length), then the size follows from the n expected readings
+        head = self.__read_exact(2)
+        if head[:1] != b'#': raise ValueError('no binary block in the reply: %r' % head)
+        digits = int(head[1:2])
+        length = int(self.__read_exact(digits)) if digits else 8*n
+        body = self.__read_exact(length)
+        if len(body) != length: raise Exception('binary block incomplete')
+        if self.__read_exact(1) != b'\n': raise ValueError('binary block not terminated')
+        values = np.frombuffer(body, dtype='<f8')
+        return float(values[0]) if len(values) == 1 else values
+            
+    def __fill(self, retries):
+        # recv blocks until data arrives or the socket times out,
+        # long integration times may need a few timeouts
+        if self._rxlen == len(self._rxbuf):
+            # a long reply (e.g. a large buffer read) does not fit, double the buffer
+            self._rxmv.release()
+            self._rxbuf.extend(bytes(len(self._rxbuf)))
+            self._rxmv = memoryview(self._rxbuf)
+        while True:
+            try:
+                n = self.device.recv_into(self._rxmv[self._rxlen:])
+                break
+            except socket.timeout:
+                retries -= 1
+                if retries <= 0: return False
+        if n == 0: raise ConnectionError('no reply, connection closed')
+        self._rxlen += n
+        return True
+    
+    def __take(self, n):
+        # first n bytes of the buffer, the rest is kept for the next reply
+        response = bytes(self._rxbuf[:n])
+        rest = self._rxlen - n
+        self._rxbuf[:rest] = self._rxbuf[n:self._rxlen]
+        self._rxlen = rest
+        return response
             
 
         
@@ -311,11 +548,16 @@ class Keithley6500:
             the extracted float of the string
 
         '''
-        temp = [float(s) for s in re.findall(r'-?\d+\.?\d*', string)]
+        # the READ? reply is a plain number like -1.234567E-03
+        try:
+            return float(string)
+        except ValueError:
+            pass
+        temp = [float(s) for s in _FLOAT_RE.findall(string)]
         if len(temp)>1:
-            temp = float(str(temp[0])+'e'+str(int(temp[1])))
+            temp = temp[0] * 10**int(temp[1])
         elif len(temp)==1:
-            temp = float(temp[0])
+            temp = temp[0]
         return temp
     
 
@@ -326,9 +568,56 @@ class MFLI:
         self.deviceid      = 'dev4580'
         self.settings_path = 'C:/Users/schneider/Documents/MasterarbeitDeOliveira/Python/fertigeModule/mfli_settings/'
         self.device        = None
+        # read back every setting right after writing it (slow), otherwise use verify_all()
+        self.verify        = False
+        self._expected     = {}
+        self._pending      = False
+        # last arguments of setLowPassFilter and setDemod per demodulator
+        self._cfg          = {}
         
     def initialize(self, deviceAdress):
         self.device        = ziPython.ziDAQServer(deviceAdress, 8004, 1)#maybe 80
+        # node paths of the 4 demodulators, oscillators and outputs, formatted once
+        self._P = {
+            'auxout_limitlower':   tuple('/%s/auxouts/%i/limitlower' % (self.deviceid, i) for i in range(4)),
+            'auxout_limitupper':   tuple('/%s/auxouts/%i/limitupper' % (self.deviceid, i) for i in range(4)),
+            'auxout_offset':       tuple('/%s/auxouts/%i/offset' % (self.deviceid, i) for i in range(4)),
+            'auxout_outputselect': tuple('/%s/auxouts/%i/outputselect' % (self.deviceid, i) for i in range(4)),
+            'demod_harmonic':      tuple('/%s/demods/%i/harmonic' % (self.deviceid, i) for i in range(4)),
+            'demod_order':         tuple('/%s/demods/%i/order' % (self.deviceid, i) for i in range(4)),
+            'demod_oscselect':     tuple('/%s/demods/%i/oscselect' % (self.deviceid, i) for i in range(4)),
+            'demod_phaseshift':    tuple('/%s/demods/%i/phaseshift' % (self.deviceid, i) for i in range(4)),
+            'demod_sample':        tuple('/%s/demods/%i/sample' % (self.deviceid, i) for i in range(4)),
+            'demod_sinc':          tuple('/%s/demods/%i/sinc' % (self.deviceid, i) for i in range(4)),
+            'demod_timeconstant':  tuple('/%s/demods/%i/timeconstant' % (self.deviceid, i) for i in range(4)),
+            'osc_freq':            tuple('/%s/oscs/%i/freq' % (self.deviceid, i) for i in range(4)),
+            'sigout_amplitudes':   tuple('/%s/sigouts/0/amplitudes/%i' % (self.deviceid, i) for i in range(4)),
+            'sigout_enables':      tuple('/%s/sigouts/0/enables/%i' % (self.deviceid, i) for i in range(4)),
+        }
+        # the demodulator samples are streamed and collected with a single poll
+        for path in self._P['demod_sample']:
+            self.device.subscribe(path)
+    
+    def _expect(self, path, value, epsilon = 0):
+        # remember a written setting for verify_all(), node paths are lower case on the device
+        self._expected[path.lower()] = (value, epsilon)
+        self._pending = True
+        
+    def verify_all(self):
+        # read back all settings in one transaction and compare with the written values
+        self.device.sync()
+        self._pending = False
+        data = self.device.get('/%s/*' % self.deviceid, flat = True)
+        failed = []
+        for path, (value, epsilon) in self._expected.items():
+            node = data.get(path)
+            if node is None:
+                continue
+            setvalue = node['value'][-1]
+            if abs(setvalue - value) > epsilon:
+                failed.append('%s = %g (expected %g)' % (path, setvalue, value))
+        if failed:
+            raise ValueError('Settings could not be verified: ' + ', '.join(failed))
     
     def listSettings(self):
         SettingsList = os.listdir(self.settings_path)
@@ -338,6 +627,7 @@ class MFLI:
     def loadSettings(self,filename):
         # load settings from filename into the device
         try:
+            self._cfg.clear()
             ut.load_settings( self.device, self.deviceid, self.settings_path + filename)
         except RuntimeError:
             print('The settings-file \"' + filename + '\" does not exist. Please select one of the following:')
@@ -357,16 +647,28 @@ class MFLI:
             len(demodulators)
         except:
             demodulators = [demodulators]
+        
+        # make sure all settings written before have arrived
+        if self._pending:
+            self.device.sync()
+            self._pending = False
             
+        # one poll returns the data of all subscribed demodulators since the last poll,
+        # each as a structured array with the fields x, y and t, the newest sample is the last
+        data = self.device.poll(0.005, 100, 0, True)
         for i in demodulators:
-            result[i] = self.device.getSample('/%s/demods/%i/sample' % (self.deviceid, i))
+            sample = data.get(self._P['demod_sample'][i])
+            if sample is None:
+                # nothing streamed in the meantime, ask for the current sample
+                sample = self.device.getSample(self._P['demod_sample'][i])
+            result[i] = _sample_array(sample)
         return result
     
     def getOutputVoltage(self, demod, unit = 'Vrms'):
-        if unit not in ['Vrms','Vpk']:
+        if unit not in _UNITS:
             raise ValueError('Voltage unit not recognized. Use \"Vrms\" or \"Vpk\"')
             
-        voltage = self.device.getDouble('/%s/sigouts/0/amplitudes/%i' % (self.deviceid, demod))
+        voltage = self.device.getDouble(self._P['sigout_amplitudes'][demod])
         
         if unit == 'Vrms':
             amplitude = voltage / math.sqrt(2)
@@ -376,39 +678,52 @@ class MFLI:
         return amplitude
     
     def getAuxOutVoltage(self, output):
-        voltage = self.device.getDouble('/%s/auxouts/%i/offset' % (self.deviceid, output))
+        voltage = self.device.getDouble(self._P['auxout_offset'][output])
         return voltage
     
     def setLowPassFilter(self, demod, order, TC, sinc = 0, TC_epsilon_factor = 1e-5):
-        if demod not in [0,1,2,3]:
+        if demod not in _CHANNELS:
             raise ValueError('This MFLI has only 4 demodulators [0,1,2,3]')
-        if order not in [1,2,3,4,5,6,7,8]:
+        if order not in _ORDERS:
             raise ValueError('Filter order can be an integer from 1 to 8')
         if TC > 250.5:
             raise ValueError('Maximum time constant = 250.5 s')
         if TC < 336.6e-9:
             raise ValueError('Minimum time constant = 336.6 ns')
-        if sinc not in [0,1]:
+        if sinc not in _SWITCH:
             raise ValueError('Sinc-Filter Error: set 0 for Off; set 1 for On.')
         
-        self.device.setInt(   '/%s/demods/%i/order'        % (self.deviceid, demod), order)
-        self.device.setDouble('/%s/demods/%i/timeconstant' % (self.deviceid, demod), TC)
-        self.device.setInt(   '/%s/demods/%i/sinc'         % (self.deviceid, demod), sinc)
-        
-        time.sleep(0.1) # necessary
-        
-        setorder = self.device.getInt(   '/%s/demods/%i/order'        % (self.deviceid, demod) )
-#        setTC    = self.device.getDouble('/%s/demods/%i/timeconstant' % (self.deviceid, demod) )
-        setsinc  = self.device.getInt(   '/%s/demods/%i/sinc'         % (self.deviceid, demod) )
-        
-        #if abs(setTC - TC) > TC_epsilon_factor * TC:
-        #    raise ValueError('TC = %5.2e s cannot be set; used TC = %5.2e s instead' % (TC,setTC) )      
+        # nothing to do if the filter is already set like this
+        key = (order, TC, sinc)
+        if self._cfg.get(('lowpass', demod)) == key:
+            return
+        
+        # all nodes in one transaction
+        self.device.set([
+            (self._P['demod_order'][demod], int(order)),
+            (self._P['demod_timeconstant'][demod], float(TC)),
+            (self._P['demod_sinc'][demod], int(sinc)),
+        ])
+        self._expect(self._P['demod_order'][demod], order)
+        self._expect(self._P['demod_sinc'][demod], sinc)
+        
+        if self.verify:
+            self.device.sync()
+            
+            setorder = self.device.getInt(   self._P['demod_order'][demod] )
+#            setTC    = self.device.getDouble(self._P['demod_timeconstant'][demod] )
+            setsinc  = self.device.getInt(   self._P['demod_sinc'][demod] )
+            
+            #if abs(setTC - TC) > TC_epsilon_factor * TC:
+            #    raise ValueError('TC = %5.2e s cannot be set; used TC = %5.2e s instead' % (TC,setTC) )      
+            
+            if order != setorder or sinc != setsinc:
+                raise ValueError('Setting the new filter settings failed due to an unexpected error')      
         
-        if order != setorder or sinc != setsinc:
-            raise ValueError('Setting the new filter settings failed due to an unexpected error')      
+        self._cfg[('lowpass', demod)] = key
     
     def setAuxOutLimits(self, output, limitlower, limitupper, limit_epsilon = 1e-6):
-        if output not in [0,1,2,3]:
+        if output not in _CHANNELS:
             raise ValueError('This MFLI has only 4 Aux outputs [0,1,2,3]')
         if limitlower > limitupper:
             raise ValueError('The lower limit has to be lower than the upper limit')
@@ -417,46 +732,53 @@ class MFLI:
         if abs(limitupper) > 10:
             raise ValueError('The upper limit exceeds the possible range [-10,10] V')
             
-        self.device.setDouble('/%s/auxouts/%i/limitlower' % (self.deviceid, output), limitlower)
-        self.device.setDouble('/%s/auxouts/%i/limitupper' % (self.deviceid, output), limitupper)
-        
-        time.sleep(0.1) # necessary
-        
-        setlimitlower = self.device.getDouble('/%s/auxouts/%i/limitlower' % (self.deviceid, output) )
-        setlimitupper = self.device.getDouble('/%s/auxouts/%i/limitupper' % (self.deviceid, output) )
-        
-        if abs(setlimitlower - limitlower) > limit_epsilon or abs(setlimitupper - limitupper) > limit_epsilon:
-            raise ValueError('Epsilon error for Aus output limits')    
+        self.device.set([
+            (self._P['auxout_limitlower'][output], float(limitlower)),
+            (self._P['auxout_limitupper'][output], float(limitupper)),
+        ])
+        self._expect(self._P['auxout_limitlower'][output], limitlower, limit_epsilon)
+        self._expect(self._P['auxout_limitupper'][output], limitupper, limit_epsilon)
+        
+        if self.verify:
+            self.device.sync()
+            
+            setlimitlower = self.device.getDouble(self._P['auxout_limitlower'][output] )
+            setlimitupper = self.device.getDouble(self._P['auxout_limitupper'][output] )
+            
+            if abs(setlimitlower - limitlower) > limit_epsilon or abs(setlimitupper - limitupper) > limit_epsilon:
+                raise ValueError('Epsilon error for Aus output limits')    
             
     def setAuxOutVoltage(self, voltage, output, voltage_epsilon = 1e-3):
-        if output not in [0,1,2,3]:
+        if output not in _CHANNELS:
             raise ValueError('This MFLI has only 4 Aux outputs [0,1,2,3]')
         
         # check if Aux channel is set to Manual
-        AuxMode = self.device.getInt(   '/%s/auxouts/%i/outputselect' % (self.deviceid, output))
+        AuxMode = self.device.getInt(   self._P['auxout_outputselect'][output])
         if AuxMode != -1:
             raise ValueError('Aux output %i (%i in the interface) is not set to manual mode' % (output, output+1) )
                 
         # read out the set limits
-        limitlower = self.device.getDouble('/%s/auxouts/%i/limitlower' % (self.deviceid, output))
-        limitupper = self.device.getDouble('/%s/auxouts/%i/limitupper' % (self.deviceid, output))
+        limitlower = self.device.getDouble(self._P['auxout_limitlower'][output])
+        limitupper = self.device.getDouble(self._P['auxout_limitupper'][output])
         
         if voltage < limitlower or voltage > limitupper:
             raise ValueError('%5.3f V does not fit in the set limits [%5.3f,%5.3f] V of Aux output %i (%i in the interface)' % (voltage,limitlower,limitupper,output, output+1))
         
-        self.device.setDouble('/%s/auxouts/%i/offset' % (self.deviceid, output), voltage)
-        
-        time.sleep(0.1) # necessary
-        
-        setvoltage = self.getAuxOutVoltage(output) 
+        self.device.setDouble(self._P['auxout_offset'][output], voltage)
+        self._expect(self._P['auxout_offset'][output], voltage, voltage_epsilon)
         
-        if abs(voltage-setvoltage) > voltage_epsilon:
-            raise ValueError('Epsilon error for Aux output voltage')        
+        if self.verify:
+            self.device.sync()
+            
+            setvoltage = self.getAuxOutVoltage(output) 
+            
+            if abs(voltage-setvoltage) > voltage_epsilon:
+                raise ValueError('Epsilon error for Aux output voltage')        
             
     def setOutputVoltage(self,voltage, demod = 0, unit = 'Vrms', voltage_epsilon_factor = 1e-3):
-        if unit not in ['Vrms','Vpk']:
+        if unit not in _UNITS:
             raise ValueError('Voltage unit not recognized. Use \"Vrms\" or \"Vpk\"')
-        if demod not in [0,1,2,3]:
+        if demod not in _CHANNELS:
             raise ValueError('This MFLI has only 4 demodulators [0,1,2,3]')
         
         if unit == 'Vrms':
@@ -471,39 +793,41 @@ class MFLI:
         if amplitude > limit:
             raise ValueError('%6.3f Vpk is to high. The limit is %i Vpk (= %6.3f Vrms) at this differential settings' % (amplitude,limit,limit/math.sqrt(2)) )
                 
-        if voltage == 0:
-            self.device.setInt('/%s/sigouts/0/enables/%i'   % (self.deviceid, demod), 0)
-        else:
-            self.device.setInt('/%s/sigouts/0/enables/%i'   % (self.deviceid, demod), 1)
+        self.device.set([
+            (self._P['sigout_enables'][demod], 0 if voltage == 0 else 1),
+            (self._P['sigout_amplitudes'][demod], float(amplitude)),
+        ])
+        self._expect(self._P['sigout_amplitudes'][demod], amplitude, voltage_epsilon_factor * amplitude)
+        
+        if self.verify:
+            self.device.sync()
             
-        self.device.setDouble('/%s/sigouts/0/amplitudes/%i' % (self.deviceid, demod), amplitude)
-        
-        time.sleep(0.1) # necessary
-        
-        setamplitude = self.getOutputVoltage(demod, unit = 'Vpk')
-                
-        if abs(amplitude-setamplitude) > voltage_epsilon_factor * amplitude:
-            raise ValueError('Epsilon error for output voltage of demod %i' % demod)
+            setamplitude = self.getOutputVoltage(demod, unit = 'Vpk')
+                    
+            if abs(amplitude-setamplitude) > voltage_epsilon_factor * amplitude:
+                raise ValueError('Epsilon error for output voltage of demod %i' % demod)
     
     def setOutputOn(self,state):
-        if state not in [0,1]:
+        if state not in _SWITCH:
             raise ValueError('Output Error: set \"0\" for Off; set \"1\" for On')
         
         self.device.setInt('/%s/sigouts/0/on' % (self.deviceid), state)
+        self._expect('/%s/sigouts/0/on' % (self.deviceid), state)
         
-        time.sleep(0.1) # necessary
-        
-        setstate = self.device.getInt('/%s/sigouts/0/on' % (self.deviceid) )
-        
-        if setstate != state:
-            raise ValueError('Setting the output On option failed due to an unexpected error')
+        if self.verify:
+            self.device.sync()
+            
+            setstate = self.device.getInt('/%s/sigouts/0/on' % (self.deviceid) )
+            
+            if setstate != state:
+                raise ValueError('Setting the output On option failed due to an unexpected error')
     
     #def autorange_Input(self):        
     #    self.device.setInt('/%s/CURRINS/n/AUTORANGE' % (self.deviceid))
     #    time.sleep(0.1) # necessary
         
     def setOscillator(self, osc, freq, freq_epsilon = 1e-3):
-        if osc not in [0,1,2,3]:
+        if osc not in _CHANNELS:
             raise ValueError('This MFLI has only 4 oscillators [0,1,2,3]')
         if freq < 0:
             raise ValueError('A frequency has to be positive')
@@ -511,8 +835,8 @@ class MFLI:
             raise ValueError('f = %4.3e Hz is not possible. Enter a frequency below 500 kHz' % freq)
         
         # check if any oscillator is locked to an external reference
-        osc1 = self.device.getInt('/%s/demods/1/oscselect' % (self.deviceid))
-        osc3 = self.device.getInt('/%s/demods/3/oscselect' % (self.deviceid))
+        osc1 = self.device.getInt(self._P['demod_oscselect'][1])
+        osc3 = self.device.getInt(self._P['demod_oscselect'][3])
         # id 0 means first demodulator which can be locked to an external reference, so 0 = demod 1 and 1 = demod 3 (number 2 and 4)
         extref1 = self.device.getInt('/%s/extrefs/0/enable'% (self.deviceid)) 
         extref3 = self.device.getInt('/%s/extrefs/1/enable'% (self.deviceid))
@@ -520,20 +844,22 @@ class MFLI:
         if (extref1 == 1 and osc1 == osc) or (extref3 == 1 and osc3 == osc):
             raise ValueError('Oscillator %i (%i in the interface) is locked to an external reference and cannot be manipulated' % (osc,osc+1))
         else:
-            self.device.setDouble('/%s/oscs/%i/freq' % (self.deviceid, osc), freq)
+            self.device.setDouble(self._P['osc_freq'][osc], freq)
+            self._expect(self._P['osc_freq'][osc], freq, freq_epsilon)
         
-            time.sleep(0.1) # necessary
-            
-            setfreq = self.device.getDouble('/%s/oscs/%i/freq' % (self.deviceid, osc) )
-            
-            if abs(setfreq - freq) > freq_epsilon:
-                raise ValueError('Epsilon error for frequency of oscillator %i' % osc)
+            if self.verify:
+                self.device.sync()
+                
+                setfreq = self.device.getDouble(self._P['osc_freq'][osc] )
+                
+                if abs(setfreq - freq) > freq_epsilon:
+                    raise ValueError('Epsilon error for frequency of oscillator %i' % osc)
                 
             
     def setDemod(self, demod, phase = 0, harmonic = 1, osc = 0, phase_epsilon = 1e-3):
-        if demod not in [0,1,2,3]:
+        if demod not in _CHANNELS:
             raise ValueError('This MFLI has only 4 demodulators [0,1,2,3]')
-        if osc not in [0,1,2,3]:
+        if osc not in _CHANNELS:
             raise ValueError('This MFLI has only 4 oscillators [0,1,2,3]')
         if harmonic < 1 or int(harmonic) != harmonic:
             raise ValueError('Harmonics have to be positive integers')            
@@ -541,21 +867,33 @@ class MFLI:
         phase = phase % 360
         if phase > 180: phase -= 360
         
-        self.device.setInt(   '/%s/demods/%i/oscselect'  % (self.deviceid, demod), osc)
-        self.device.setDouble('/%s/demods/%i/phaseshift' % (self.deviceid, demod), phase)
-        self.device.setDouble('/%s/demods/%i/harmonic'   % (self.deviceid, demod), harmonic)
+        key = (phase, harmonic, osc)
+        if self._cfg.get(('demod', demod)) == key:
+            return
+        
+        self.device.set([
+            (self._P['demod_oscselect'][demod], int(osc)),
+            (self._P['demod_phaseshift'][demod], float(phase)),
+            (self._P['demod_harmonic'][demod], float(harmonic)),
+        ])
+        self._expect(self._P['demod_oscselect'][demod], osc)
+        self._expect(self._P['demod_phaseshift'][demod], phase, phase_epsilon)
+        self._expect(self._P['demod_harmonic'][demod], harmonic)
                 
-        time.sleep(0.1) # necessary
+        if self.verify:
+            self.device.sync()
 
-        setosc      = self.device.getInt(   '/%s/demods/%i/oscselect'  % (self.deviceid, demod) )
-        setphase    = self.device.getDouble('/%s/demods/%i/phaseshift' % (self.deviceid, demod) )
-        setharmonic = self.device.getDouble('/%s/demods/%i/harmonic'   % (self.deviceid, demod) )
-                
-        if abs( setphase - phase ) > phase_epsilon:
-            raise ValueError('phase = %6.3f ° cannot be set; used phase = %6.3f ° instead' % (phase, setphase) )      
+            setosc      = self.device.getInt(   self._P['demod_oscselect'][demod] )
+            setphase    = self.device.getDouble(self._P['demod_phaseshift'][demod] )
+            setharmonic = self.device.getDouble(self._P['demod_harmonic'][demod] )
+                    
+            if abs( setphase - phase ) > phase_epsilon:
+                raise ValueError('phase = %6.3f ° cannot be set; used phase = %6.3f ° instead' % (phase, setphase) )      
+            
+            if setosc != osc or setharmonic != harmonic:
+                raise ValueError('Setting the demodulator settings failed due to an unexpected error')         
         
-        if setosc != osc or setharmonic != harmonic:
-            raise ValueError('Setting the demodulator settings failed due to an unexpected error')         
+        self._cfg[('demod', demod)] = key
         
 #    To set an external reference properly one has to manipulate (or at least check) the signal input settings 
 #    as well because the MFLI wont give back any errors (see setOscillator function)
@@ -567,6 +905,7 @@ class MFLI:
         
     def close(self):
         self.setOutputOn(0)
+        self.device.unsubscribe('*')
         #self.device.close()
         return
         
@@ -582,6 +921,7 @@ class MagnetPhysik_FH55:
         self.acdcMode = None
         self.autorange = None
         self.temperatureCorrection = None
+        self.temperatureMode = None
   
     def initialize(self, port):
         self.port = port
@@ -589,11 +929,15 @@ class MagnetPhysik_FH55:
         self.time_to_wait_in_s_forSetting = 0.3
         
         try:
-            self.device = serial.Serial(port, 19200, timeout = 0.1)
+            # the timeout bounds a whole reply, read_until returns as soon as the CR arrives
+            self.device = serial.Serial(port, 19200, timeout = 1)
+            # cut the latency timer of USB serial adapters (only available on Linux)
+            if hasattr(self.device, 'set_low_latency_mode'):
+                try: self.device.set_low_latency_mode(True)
+                except (OSError, ValueError): pass
             time.sleep(self.time_to_wait_in_s_forSetting)
             self.device.write(('?PING'+ chr(13)).encode())
-            time.sleep(self.time_to_wait_in_s_forSetting)
-            rcv = self.device.read(24).decode()
+            rcv = self.device.read_until(b'\r', 24).decode('ascii', errors='ignore')
             if(rcv[0:5]!='ERROR'): raise Exception('Connection error, NO CONNECTION')
             self.reset('setVariables')        
         except Exception as e: print(__class__.__name__,'.initialize(), connection or setting Error ', e)
@@ -608,6 +952,7 @@ class MagnetPhysik_FH55:
                 self.acdcMode = None
                 self.autorange = None
                 self.temperatureCorrection = None
+                self.temperatureMode = None
             if 'setVariables' in option: 
                 self.set_mode('DC')
                 self.set_temperatureCorrectionOn()
@@ -631,27 +976,21 @@ class MagnetPhysik_FH55:
         try:
             command = "?" + string + chr(13)
             self.device.write(command.encode())
-            time.sleep(self.time_to_wait_in_s_forReading)
-            answer = ""
-            for i in range(24):
-                temp = self.device.read()
-                if temp == b'\r': break
-                answer = answer + temp.decode()
-            return answer.lstrip()
+            return self.__readline()
         except: print(__class__.__name__,'__read(), could not read')
   
     def __write(self, string):
         try:
             command = "#" + string + chr(13)
             self.device.write(command.encode())
-            time.sleep(self.time_to_wait_in_s_forSetting)
-            answer = ""
-            for timeout in range(20):
-                temp = self.device.read()
-                if temp == b'\r': break
-                answer = answer + temp.decode()
-            return answer.lstrip()
+            return self.__readline()
         except: print(__class__.__name__,'__write(), could not write')
+        
+    def __readline(self):
+        # one blocking read up to the terminating CR
+        raw = self.device.read_until(b'\r', 24)
+        if raw.endswith(b'\r'): raw = raw[:-1]
+        return raw.decode('ascii', errors='ignore').lstrip()
     
     def set_range(self, expectedMaxValue):
         """
@@ -670,11 +1009,8 @@ class MagnetPhysik_FH55:
         try:
             if (float(expectedMaxValue)>3) or (float(expectedMaxValue)<0): raise ValueError('0 < expectedMaxValue < 3')
             
-            ranges_dict={3:3e-3,4:30e-3,5:300e-3,6:3}
-            for k,v in ranges_dict.items(): 
-                if v>=float(expectedMaxValue):
-                    temp_range = k
-                    break
+            # smallest range that covers the expected value
+            temp_range = _RANGE_CODES[bisect.bisect_left(_RANGE_THRESHOLDS, float(expectedMaxValue))]
             if temp_range !=self.measurement_range:
                 ret = self.__write("RANGE "+ str(temp_range))
                 if ret == 'ERROR': raise Exception('Could not change the range')
@@ -685,8 +1021,7 @@ class MagnetPhysik_FH55:
         
     def get_range(self):
         try:
-            ranges_dict={3:3e-3,4:30e-3,5:300e-3,6:3}
-            return ranges_dict[self.measurement_range]
+            return _RANGE_THRESHOLDS[_RANGE_CODES.index(self.measurement_range)]
         except: print('problem getting the range')
     
     def set_mode(self, mode):
@@ -759,7 +1094,8 @@ class MagnetPhysik_FH55:
         returns the temperature of the Sensor in celcius-degree
         """
         try:
-            self.__write("TEMP 1")
+            if self.temperatureMode != 1:
+                if "TEMP 1" == self.__write("TEMP 1"): self.temperatureMode = 1
             return (self.__read("TEMP"))[:-2]
         except: print(__class__.__name__,'.get_temperature(), problem with getting the temperature of the sensor')
         
@@ -819,18 +1155,25 @@ class CaenelsFastPS:
     def __init__(self):
         self.deviceport = None
         self.device = None
+        self._server_address = None
         self.try_to_connect = 10
         self.mode = None #cc or cv
         self.model = None
-        self.ControlMode = None
+        self.control_mode = None #A(analog),N(normal)
         self.output_state= None #0(OFF),1(ON)
         self.floating_output = None
         self.slewRateVoltage = None
         self.slewRateCurrent = None
         self.actual_voltage = None
         self.actual_current = None
-        
-    def initialize(self, ip, port, model):
+        # receive buffer, may hold the start of the next reply
+        self._rxbuf = bytearray(1024)
+        self._rxmv = memoryview(self._rxbuf)
+        self._rxlen = 0
+        # single worker for the ramp down, started by close_async() and shut down after it
+        self._executor = None
+        
+    def initialize(self, ip, port, model, tcp_buf=128*1024):
         """
         defines the device\n
 
@@ -840,58 +1183,68 @@ class CaenelsFastPS:
             "192.168.0.10
         port : integer
             10001
+        tcp_buf : integer
+            size of the socket send and receive buffers in bytes
 
         Returns
         -------
         None.
         """
         
-        try:
-            if model not in [2040, 3050]: raise ValueError('This model is not known')
-            if model==2040:
-                self.max_current = 20.0
-                self.max_voltage = 40.0
-                self.max_slewRateCurrent = 200.0
-                self.max_slewRateVoltage = 400.0
-                self.time_to_wait_in_s = 0.01
-            if model==3050:
-                self.max_current = 30.0
-                self.max_voltage = 50.0
-                self.max_slewRateCurrent = 200.0
-                self.max_slewRateVoltage = 400.0
-                self.time_to_wait_in_s = 0.01
-            server_address = (ip, port)
-            self.device = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.device.connect(server_address)
-            time.sleep(1)
-            self.reset('device')
-            self.mode = (self.__query('LOOP:?'))[-3:-2]
-            self.__query('PASSWORD:ps-admin')
-            self.__query('MWG:90:0x1') #set Interlock 1 as active
-            self.model=model
-            self.set_outputOff()
-            self.get_current()
-            self.get_voltage()
-            self.set_analogInputMode(False)
-            self.floating_output = self.__query('SETFLOAT:?')[-3:-2] #Check the query 
-            self.slewRateCurrent = self.__convertStrToFloat((self.__query('MSRI:?'))[-4:-2])
-            self.slewRateVoltage = self.__convertStrToFloat((self.__query('MSRV:?'))[-4:-2])
-
-        except:
-            if (self.try_to_connect>0):
-                print(__class__.__name__,'.initialize(), can not connect, be patient, i will try it again...')
-                self.try_to_connect = self.try_to_connect-1
-                self.initialize(ip, port, model)
-            else: 
-                self.device.close()
-                print(__class__.__name__,'.initialize(), could not connect after 10 try')
+        if model not in _MODEL_SPECS:
+            print(__class__.__name__,'.initialize(), invalid input param, This model is not known')
+            return
+        self.__dict__.update(_MODEL_SPECS[model])
+        server_address = (ip, port)
+        self._server_address = server_address
+        
+        # a fresh socket for every attempt, the failed one is closed
+        for attempt in range(self.try_to_connect):
+            try:
+                if not self.__reuse(server_address):
+                    self.device = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    # buffer sizes have to be set before connecting to take effect on the TCP window
+                    self.device.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, tcp_buf)
+                    self.device.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, tcp_buf)
+                    self.device.connect(server_address)
+                    # send each short command immediately, keep the idle connection alive
+                    self.device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.device.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    # on Linux, poll the network driver for 50 us before sleeping on a reply
+                    if sys.platform.startswith('linux'):
+                        try: self.device.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BUSY_POLL', 46), 50)
+                        except OSError: pass
+                    # replies are awaited on the socket, the timeout is only the fallback
+                    self.device.settimeout(100 * self.time_to_wait_in_s)
+                    self._rxlen = 0
+                    self.__wait_ready()
+                    self.reset('device')
+                # fixed command sequences are sent at once, the replies are read afterwards
+                ret = self.__query_many(['LOOP:?', 'PASSWORD:ps-admin', 'MWG:90:0x1']) #set Interlock 1 as active
+                if ret[0] == 'Error': raise ConnectionError('no reply from the device')
+                self.mode = ret[0][-3:-2]
+                self.model=model
+                self.set_outputOff()
+                self.set_analogInputMode(False)
+                ret = self.__query_many(['MRI', 'MRV', 'SETFLOAT:?', 'MSRI:?', 'MSRV:?'])
+                self.actual_current = self.__convertStrToFloat(ret[0])
+                self.actual_voltage = self.__convertStrToFloat(ret[1])
+                self.floating_output = ret[2][-3:-2] #Check the query 
+                self.slewRateCurrent = self.__convertStrToFloat(ret[3][-4:-2])
+                self.slewRateVoltage = self.__convertStrToFloat(ret[4][-4:-2])
+                return
+            except Exception as e:
+                print(__class__.__name__,'.initialize(), can not connect, be patient, i will try it again...', e)
+                if self.device is not None: self.device.close()
+                time.sleep(1)
+        print(__class__.__name__,'.initialize(), could not connect after %i tries' % self.try_to_connect)
 
     def reset(self, option):
         try:
             if option not in ["device","variables","all"]: raise ValueError('option only ["device","variables","all"]')
             if option == 'all': option = ["device","variables"]
             if 'device' in option: 
-                self.__send('MRESET')
+                self.__query('MRESET')
                 self.get_current()
                 self.get_voltage()
             if 'variables' in option:
@@ -904,34 +1257,133 @@ class CaenelsFastPS:
             self.slewRateCurrent = self.__convertStrToFloat((self.__query('MSRI:?'))[-4:-2])
             self.slewRateVoltage = self.__convertStrToFloat((self.__query('MSRV:?'))[-4:-2])
         except ValueError as e: print(__class__.__name__,'.reset(), invalid input param, ',e)
-        except: print(__class__.__name__,'.reset(), problems resetting the device')
+        except OSError as e: print(__class__.__name__,'.reset(), problems resetting the device, ',e)
 
-    def close(self):
+    def __wait_ready(self, max_wait=1.0):
+        # the service needs a moment after connecting, ask until it answers instead of a fixed pause
+        timeout = self.device.gettimeout()
+        deadline = time.monotonic() + max_wait
+        # MRV commands sent and not answered yet
+        sent = 0
+        try:
+            self.device.settimeout(0.05)
+            while time.monotonic() < deadline:
+                self.__send(_CMD_MRV)
+                sent += 1
+                try:
+                    line = self.__readline()
+                    sent -= 1
+                    if line.startswith('#'): break
+                except socket.timeout:
+                    pass
+                time.sleep(0.02)
+            # one reply per MRV: read the late replies to the other attempts,
+            # otherwise every later query would get the reply of the command before
+            self.device.settimeout(0.2)
+            while sent:
+                try: self.__readline()
+                except socket.timeout: break
+                sent -= 1
+            self._rxlen = 0
+        finally:
+            self.device.settimeout(timeout)
+
+    def __reuse(self, server_address):
+        # take over the connection of an earlier run if it is still open, it is taken out
+        # of the pool, so that a connection never has two owners
+        sock = _CONN_POOL.pop(server_address, None)
+        if sock is None: return False
+        try: sock.getpeername()
+        except OSError:
+            sock.close()
+            return False
+        self.device = sock
+        self._rxlen = 0
+        return True
+
+    def close(self, disconnect=True):
+        # disconnect=False ramps down and switches off, but keeps the connection for the next initialize()
+        # the ramp down takes |I|/rate (|U|/rate in cv mode), then allow a margin for the commands
+        if self.mode == 'V': ramp = abs(self.actual_voltage or 0.0) / 15
+        else: ramp = abs(self.actual_current or 0.0) / 10
+        try: self.close_async(disconnect).result(timeout=ramp + 10)
+        except concurrent.futures.TimeoutError: print(__class__.__name__,'.close(), the ramp down did not finish in time')
+
+    def close_async(self, disconnect=True):
+        """
+        ramps down and switches off in the background\n
+
+        Returns
+        -------\n
+        concurrent.futures.Future, done when the device is off.
+        Several supplies can be ramped down in parallel this way.
+
+        """
+        if self._executor is None:
+            # single worker, so the ramp down never overlaps other commands sent through it
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self.__shutdown, disconnect)
+
+    def __shutdown(self, disconnect):
         try:
             if self.output_state==1:
                 if self.mode == 'I': self.set_rampToCurrent(0.0,10)
                 elif self.mode == 'V': self.set_rampToVoltage(0.0,15)
             self.set_outputOff()
-            self.device.close()
-        except: print(__class__.__name__,'.close(), error when closing the device')
+            if disconnect:
+                self.device.close()
+            else:
+                # handed over to the next initialize() with the same address
+                _CONN_POOL[self._server_address] = self.device
+        except OSError as e: print(__class__.__name__,'.close(), error when closing the device, ',e)
+        finally:
+            # last task of this instance, the worker thread ends after it
+            self._executor.shutdown(wait=False)
+            self._executor = None
         
     
     def __send(self, cmd):
-        s = cmd + '\r'
-        try: self.device.send(s.encode())
-        except: print(__class__.__name__,'.__send(), could not send the command '+cmd)
-        finally: time.sleep(self.time_to_wait_in_s)
+        # bytes are sent as they are (terminator included), str gets the terminator and is encoded
+        if isinstance(cmd, str): cmd = (cmd + '\r').encode()
+        try: self.device.sendall(cmd)
+        except OSError as e: print(__class__.__name__,'.__send(), could not send the command', cmd, e)
     
     def __query(self, cmd):
         self.__send(cmd)
-        time.sleep(self.time_to_wait_in_s)
         try: 
-            ret = self.device.recv(30).decode()
-        except: 
-            print(__class__.__name__,'.__query(), could not receive data')
+            ret = self.__readline()
+        except (OSError, UnicodeDecodeError) as e: 
+            print(__class__.__name__,'.__query(), could not receive data', e)
             ret = 'Error'
         finally: return ret
     
+    def __query_many(self, cmds):
+        # send all commands in one go, then collect one reply per command
+        try: self.device.sendall(''.join(cmd + '\r' for cmd in cmds).encode())
+        except OSError as e: print(__class__.__name__,'.__query_many(), could not send the commands '+', '.join(cmds), e)
+        ret = []
+        try:
+            for cmd in cmds:
+                ret.append(self.__readline())
+        except (OSError, UnicodeDecodeError) as e: 
+            print(__class__.__name__,'.__query_many(), could not receive data', e)
+        return ret + ['Error'] * (len(cmds) - len(ret))
+    
+    def __readline(self):
+        # recv returns as soon as data arrives, read on until the reply is complete,
+        # anything after the line end belongs to the next reply
+        while True:
+            end = self._rxbuf.find(b'\n', 0, self._rxlen)
+            if end >= 0: break
+            n = self.device.recv_into(self._rxmv[self._rxlen:])
+            if n == 0: raise ConnectionError('connection closed or buffer full')
+            self._rxlen += n
+        line = self._rxbuf[:end+1].decode('ascii')
+        rest = self._rxlen - end - 1
+        self._rxbuf[:rest] = self._rxbuf[end+1:self._rxlen]
+        self._rxlen = rest
+        return line
+    
     def set_outputFloating(self, floatingGround):
         """ This method set if the outout is floating or not\n
         Parameters
@@ -948,8 +1400,8 @@ class CaenelsFastPS:
             if self.floating_output != floatingGround:
                 if floatingGround == 'floating': ret = self.__query('SETFLOAT F')
                 elif floatingGround == 'ground': ret = self.__query('SETFLOAT N')
-                if "NAK"==ret[1:4]: print('The output state could not be set, see error code '+str(ret[4:7])) 
-                elif "AK"==ret[1:3]: self.output_state=1 
+                if ret.startswith(_NAK, 1): print('The output state could not be set, see error code '+str(ret[4:7])) 
+                elif ret.startswith(_AK, 1): self.output_state=1 
         except ValueError as v: print(__class__.__name__,'.set_outputFloating(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_outputFloating(), error: ',e)
                 
@@ -957,20 +1409,20 @@ class CaenelsFastPS:
     def set_outputOn(self):
         try:
             if self.output_state!=1:
-                ret = self.__query('MON')
-                if "NAK"==ret[1:4]: 
+                ret = self.__query(_CMD_MON)
+                if ret.startswith(_NAK, 1): 
                     print('Device could not be turned on, see error code '+str(ret[4:7])) 
                     if(ret[4:7]==':08'):
                         print('Interlock is open, overtemperature of magnet? If it is cooled down and the guard resetted!')
-                elif "AK"==ret[1:3]: self.output_state=1 
+                elif ret.startswith(_AK, 1): self.output_state=1 
         except Exception as e: print(__class__.__name__,'.set_outputOn(), error: ', e)
         
     def set_outputOff(self):
         try:
             if self.output_state!=0:
-                ret = self.__query('MOFF')
-                if "NAK"==ret[1:4]: print('Device could not be turned off, see error code '+str(ret[4:7])) 
-                elif "AK"==ret[1:3]: self.output_state=0
+                ret = self.__query(_CMD_MOFF)
+                if ret.startswith(_NAK, 1): print('Device could not be turned off, see error code '+str(ret[4:7])) 
+                elif ret.startswith(_AK, 1): self.output_state=0
         except Exception as e: print(__class__.__name__,'.set_outputOff(), error: ', e)
     
     def get_voltage(self):
@@ -981,8 +1433,8 @@ class CaenelsFastPS:
         float: the voltage as a float
 
         """
-        try: self.actual_voltage = (self.__convertStrToFloat(str(self.__query('MRV'))))
-        except: print(__class__.__name__,'.get_voltage(), error occured')
+        try: self.actual_voltage = self.__convertStrToFloat(self.__query(_CMD_MRV))
+        except (OSError, ValueError) as e: print(__class__.__name__,'.get_voltage(), error occured', e)
         finally: return self.actual_voltage
    
     def get_current(self):
@@ -990,8 +1442,8 @@ class CaenelsFastPS:
         Returns:
             float: the actual output current
         """
-        try: self.actual_current = (self.__convertStrToFloat(str(self.__query('MRI'))))
-        except: print(__class__.__name__,'.get_current(), error occurred')
+        try: self.actual_current = self.__convertStrToFloat(self.__query(_CMD_MRI))
+        except (OSError, ValueError) as e: print(__class__.__name__,'.get_current(), error occurred', e)
         finally: return self.actual_current
     
     def set_voltage(self, voltage):
@@ -1006,13 +1458,15 @@ class CaenelsFastPS:
         None
         """
         try:
-            if abs(float(voltage))>self.max_voltage: raise ValueError('voltage < +/- {}'.format(self.maxVoltage))
+            # convert once, fixed point notation in the command, formatted straight into bytes
+            v = float(voltage); s = b'%.6f' % v
+            if abs(v)>self.max_voltage: raise ValueError('voltage < +/- {}'.format(self.max_voltage))
             self.set_cvMode()
             self.set_outputOn()
-            t_temp = abs(float(voltage)-self.actual_voltage)/self.max_slewRateVoltage    
-            ret = self.__query('MWV:'+str(voltage))    
-            if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(voltage))
-            if (ret[1:3])=='AK': self.actual_voltage=voltage
+            t_temp = abs(v-self.actual_voltage)/self.max_slewRateVoltage    
+            ret = self.__query(b'MWV:%s\r' % s)    
+            if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',s.decode())
+            if ret.startswith(_AK, 1): self.actual_voltage=v
             time.sleep(t_temp)
         except ValueError as v: print(__class__.__name__,'.set_voltage(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_voltage(), error: ', e)
@@ -1029,13 +1483,15 @@ class CaenelsFastPS:
         None
         '''
         try:
-            if abs(float(current))>self.max_current: raise ValueError('current < +/- {}'.format(self.maxCurrent))
+            # convert once, fixed point notation in the command, formatted straight into bytes
+            c = float(current); s = b'%.6f' % c
+            if abs(c)>self.max_current: raise ValueError('current < +/- {}'.format(self.max_current))
             self.set_ccMode()
             self.set_outputOn()
-            t_temp = abs(float(current)-self.actual_current)/self.max_slewRateCurrent
-            ret = self.__query('MWI:'+str(current))    
-            if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(current))
-            if (ret[1:3])=='AK': self.actual_current=current
+            t_temp = abs(c-self.actual_current)/self.max_slewRateCurrent
+            ret = self.__query(b'MWI:%s\r' % s)    
+            if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',s.decode())
+            if ret.startswith(_AK, 1): self.actual_current=c
             time.sleep(t_temp)
         except ValueError as v: print(__class__.__name__,'.set_current(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_current(), error: ', e)
@@ -1053,16 +1509,18 @@ class CaenelsFastPS:
         None
         '''
         try: 
-            if abs(float(current))>self.max_current: raise ValueError('current < +/- {}'.format(self.max_current))
+            # convert once, fixed point notation in the command, formatted straight into bytes
+            c = float(current); s = b'%.6f' % c; rate = float(slewRateAmpPerSec)
+            if abs(c)>self.max_current: raise ValueError('current < +/- {}'.format(self.max_current))
             self.set_ccMode()
             self.set_outputOn()
-            self.set_currentSlewRate(float(slewRateAmpPerSec))
+            self.set_currentSlewRate(rate)
             
-            ret = self.__query('MWIR:'+str(current))
-            if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(current))
-            if (ret[1:3])=='AK': 
-                time.sleep(abs(current-self.actual_current)/float(slewRateAmpPerSec))
-                self.actual_current=current
+            ret = self.__query(b'MWIR:%s\r' % s)
+            if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',s.decode())
+            if ret.startswith(_AK, 1): 
+                time.sleep(abs(c-self.actual_current)/rate)
+                self.actual_current=c
         except ValueError as v: print(__class__.__name__,'.set_rampToCurrent(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_rampToCurrent(), error: ', e)
             
@@ -1078,19 +1536,29 @@ class CaenelsFastPS:
         None
         '''            
         try: 
-            if abs(float(voltage))>self.max_voltage: raise ValueError('voltage < +/- {}'.format(self.max_voltage))
+            # convert once, fixed point notation in the command, formatted straight into bytes
+            v = float(voltage); s = b'%.6f' % v; rate = float(slewRateVoltPerSec)
+            if abs(v)>self.max_voltage: raise ValueError('voltage < +/- {}'.format(self.max_voltage))
             self.set_cvMode()
             self.set_outputOn()
-            self.set_voltageSlewRate(float(slewRateVoltPerSec))
+            self.set_voltageSlewRate(rate)
             
-            ret = self.__query('MWVR:'+str(voltage))
-            if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(voltage))
-            if (ret[1:3])=='AK': 
-                time.sleep(abs(voltage-self.actual_voltage)/float(slewRateVoltPerSec))
-                self.actual_voltage=voltage
+            ret = self.__query(b'MWVR:%s\r' % s)
+            if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',s.decode())
+            if ret.startswith(_AK, 1): 
+                time.sleep(abs(v-self.actual_voltage)/rate)
+                self.actual_voltage=v
         except ValueError as v: print(__class__.__name__,'.set_rampToVoltage(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_rampToVoltage(), error: ',e)
             
+    def __loop(self, mode):
+        # the loop can only be changed with the output off, send MOFF and LOOP in one round trip
+        if self.output_state == 0: return self.__query('LOOP:'+mode)
+        off, ret = self.__query_many(['MOFF', 'LOOP:'+mode])
+        if off.startswith(_NAK, 1): print('Device could not be turned off, see error code '+str(off[4:7]))
+        elif off.startswith(_AK, 1): self.output_state=0
+        return ret
+
     def set_ccMode(self):
         '''sets the constant current mode\n
         Returns
@@ -1099,10 +1567,9 @@ class CaenelsFastPS:
         '''
         try: 
             if self.mode != 'I':
-                self.set_outputOff()
-                ret = self.__query('LOOP:I')
-                if (ret[1:4])=='NAK': raise Exception('could not set the device to cc-mode')
-                if (ret[1:3])=='AK': self.mode = 'I'
+                ret = self.__loop('I')
+                if ret.startswith(_NAK, 1): raise Exception('could not set the device to cc-mode')
+                if ret.startswith(_AK, 1): self.mode = 'I'
         except Exception as e:  print(__class__.__name__,'.set_ccMode(), error: ',e)
 
     def set_cvMode(self):
@@ -1113,22 +1580,21 @@ class CaenelsFastPS:
         '''
         try: 
             if self.mode != 'V':
-                self.set_outputOff()
-                ret = self.__query('LOOP:V')
-                if (ret[1:4])=='NAK': raise Exception('could not set the device to cv-mode')
-                if (ret[1:3])=='AK': self.mode = 'V'
+                ret = self.__loop('V')
+                if ret.startswith(_NAK, 1): raise Exception('could not set the device to cv-mode')
+                if ret.startswith(_AK, 1): self.mode = 'V'
         except Exception as e:  print(__class__.__name__,'.set_cvMode(), error: ',e)
     
     def set_analogInputMode(self,active):
         try:
-            if self.model=='2040' and (self.controlMode!=active):
-                if active==1:
+            mode = 'A' if active else 'N'
+            if self.model==2040 and (self.control_mode!=mode):
+                if active:
                     ret = self.__query('UPMODE:ANALOG')
-                    if (ret[1:3])=='AK': self.ControlMode = 'A'
-                if active==0:
+                else:
                     ret = self.__query('UPMODE:NORMAL')
-                    if (ret[1:3])=='AK': self.ControlMode = 'N'
-                if (ret[1:4])=='NAK': raise Exception('could not set the device to specified control-mode')
+                if ret.startswith(_AK, 1): self.control_mode = mode
+                if ret.startswith(_NAK, 1): raise Exception('could not set the device to specified control-mode')
         except Exception as e:  print(__class__.__name__,'.set_analogInputMode(), error: ',e)
         
         
@@ -1144,12 +1610,14 @@ class CaenelsFastPS:
         '''
         try:
             ampPerSec = abs(ampPerSec)
+            # unchanged, no need to touch the mode either
+            if self.slewRateCurrent == ampPerSec: return
             self.set_ccMode()
             if self.max_slewRateCurrent<ampPerSec : raise ValueError('ampPerSec < {}'.format(self.max_slewRateCurrent))
             if self.slewRateCurrent!=ampPerSec :
                 ret = self.__query('MSRI:'+str(ampPerSec))
-                if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(ampPerSec))
-                if (ret[1:3])=='AK': self.slewRateCurrent = ampPerSec
+                if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',str(ampPerSec))
+                if ret.startswith(_AK, 1): self.slewRateCurrent = ampPerSec
         except ValueError as v: print(__class__.__name__,'.set_currentSlewRate(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_currentSlewRate(), error: ',e)
         
@@ -1164,12 +1632,14 @@ class CaenelsFastPS:
         None
         '''
         try:
+            # unchanged, no need to touch the mode either
+            if self.slewRateVoltage == voltPerSec: return
             self.set_cvMode()
             if self.max_slewRateVoltage<voltPerSec : raise ValueError('voltPerSec < {}'.format(self.max_slewRateVoltage))
             if self.slewRateVoltage!=voltPerSec :
                 ret = self.__query('MSRV:'+str(voltPerSec))
-                if (ret[1:4])=='NAK': raise Exception('could not set the device with the specified parameter ',str(voltPerSec))
-                if (ret[1:3])=='AK': self.slewRateVoltage = voltPerSec
+                if ret.startswith(_NAK, 1): raise Exception('could not set the device with the specified parameter ',str(voltPerSec))
+                if ret.startswith(_AK, 1): self.slewRateVoltage = voltPerSec
         except ValueError as v: print(__class__.__name__,'.set_voltageSlewRate(), invalid input param, ',v)
         except Exception as e:  print(__class__.__name__,'.set_voltageSlewRate(), error: ',e)
                
@@ -1186,12 +1656,17 @@ class CaenelsFastPS:
 
         '''
         try:
-            temp = [float(s) for s in re.findall(r'-?\d+\.?\d*', string)]
+            # replies look like #MRI:1.234567, the number follows the last colon
+            return float(string.rpartition(':')[2])
+        except ValueError:
+            pass
+        try:
+            temp = [float(s) for s in _FLOAT_RE.findall(string)]
             if len(temp)>1:
-                temp = float(str(temp[0])+'e'+str(int(temp[1])))
+                temp = temp[0] * 10.0**int(temp[1])
             elif len(temp)==1:
-                temp = float(temp[0])
-        except: 
+                temp = temp[0]
+        except (ValueError, OverflowError): 
             print('There is a problem with coverting the string to a float, class CaenelsFastPS, method __convertStrToFloat')
             temp = 999999999
         finally: return temp
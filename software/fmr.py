@@ -20,16 +20,18 @@
 
 
 import time 
+import sys
 import numpy as np
+from functools import lru_cache
+import concurrent.futures
 
 import devices
 
-import pylab
+import matplotlib.pyplot as plt
 
 import zipfile
+import io
 
-import warnings
-from scipy.interpolate import interp1d
 import os
 
 # physical constants
@@ -38,6 +40,51 @@ muB = 9.274e-24
 h = 6.626e-34
 e = 1.602e-19
 me = 9.11e-31
+
+
+# progress line of a field sweep, the GUI picks up the data lines between <> and </>
+_PROG_FMT = "\r Field: {:8.5f} T  | X: {:12.8f} V | Y: {:12.8f} V | Progress: {:5.1f}% "
+_PROG_FMT_GUI = "\r<> Field: {:8.5f} T  | X: {:12.8f} V | Y: {:12.8f} V | Progress: {:5.1f}% </>"
+
+
+# magnet calibration tables by file path, shared by all Field instances
+@lru_cache(maxsize=8)
+def _load_xy(path):
+    data = np.loadtxt(path, unpack=True)
+    # shared between callers, must not be changed
+    data.flags.writeable = False
+    return data
+
+
+def clear_calibration_cache():
+    # call after a calibration file was rewritten (e.g. by tools/calibrate_magnet.py)
+    _load_xy.cache_clear()
+
+
+# field range estimators, plain functions of scalars or arrays (e.g. all frequencies at once)
+def kittel_resonance_field_ip(f, M, gamma_prime):
+    return - mu0*M/2 + np.sqrt(mu0**2 * M**2 / 4 + f**2 / gamma_prime**2)
+
+
+def kittel_resonance_field_oop(f, M, gamma_prime):
+    return np.abs(f / gamma_prime + mu0*M)
+
+
+def delta_B(f, alpha, deltaB0, gamma_prime):
+    return alpha * f / gamma_prime + deltaB0
+
+
+def calc_B_range(B0, deltaB, multiplier=8, sampling=6, offset=0.0):
+    start = B0 - multiplier*deltaB
+    stop = B0 + multiplier*deltaB
+    step = deltaB / sampling
+    if start < 0.0:
+        start = 0.0
+    # fixed number of points, the end point does not depend on float rounding like with arange
+    n = int(round((stop - start) / step)) + 1
+    B = np.linspace(start, stop, n) + offset
+    return B
+
             
 class System():
     def __init__(self):
@@ -57,7 +104,8 @@ class System():
         
     def lockin_read_XY(self):
         mfli_sample = self.mfli.getDemodSample(demodulators=(0))
-        x, y = mfli_sample[0]['x'][0], mfli_sample[0]['y'][0]
+        # newest sample
+        x, y = mfli_sample[0]['x'][-1], mfli_sample[0]['y'][-1]
         return x, y
     
     
@@ -66,6 +114,8 @@ class System():
         self.mfli.setOscillator(0, self.modulator_frequency)
         self.mfli.setOutputVoltage(output_voltage_rms, demod = 0, unit = 'Vrms')
         self.mfli.setOutputOn(output)
+        # check all lock-in settings with a single read back
+        self.mfli.verify_all()
         
         
     def signalgenerator_settings(self, frequency, power, output):
@@ -75,6 +125,12 @@ class System():
 
 
     def signalgenerator_power(self, frequency):
+        return self._power(float(frequency))
+
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _power(frequency):
         # helper function to determine the best power as a function of frequency
         # you have to tune this, so that the diode detector voltage remains
         # approximately constant across all frequencies, while maxing out the power
@@ -95,6 +151,9 @@ class System():
         
 
 class Field():
+    # nonlinearity of the FH55 analog output, relative deviation per volt
+    _NL = 0.065/3.0
+
     def __init__(self):
         
         # magnet power supply
@@ -108,6 +167,9 @@ class Field():
         self.Teslameter.set_range(300e-3)
         time.sleep(1)
         self.teslameter_multiplier = 0.1
+        # last range and mode sent to the teslameter, a change needs 1s to settle
+        self.teslameter_range = 300e-3
+        self.teslameter_mode = None
         
         # Keithley DMM 6500 for analog readout of the Teslameter (faster!)
         self.dmm = devices.Keithley6500()
@@ -118,58 +180,79 @@ class Field():
         #self.calibration_file = "DXWD-80_5mm"
     
     
-    def get_current_from_field(self, field, kind='linear'):
-        current_path = os.getcwd()
-        data = np.loadtxt(current_path+'\\'+self.calibration_file+'.xy', unpack=True)
-        i ,f = data
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            current_interp = interp1d(f, i, kind=kind)
-            curr = current_interp(field,)
-        return curr
+    @property
+    def calibration_file(self):
+        return self._calibration_file
+
+
+    @calibration_file.setter
+    def calibration_file(self, name):
+        # a new calibration is loaded on its first use, the file is in the working directory
+        self._calibration_file = name
+        self._calibration_path = os.path.join(os.getcwd(), name + '.xy')
+        self._f = None
+
+
+    def _load_calibration(self):
+        i, f = _load_xy(self._calibration_path)
+        # np.interp needs increasing fields
+        order = np.argsort(f)
+        self._i, self._f = i[order], f[order]
+
+
+    def get_current_from_field(self, field):
+        # linear interpolation of the calibration, field can be a scalar or an array
+        if self._f is None:
+            self._load_calibration()
+        if np.min(field) < self._f[0] or np.max(field) > self._f[-1]:
+            raise ValueError("Field outside of the magnet calibration (%.4fT to %.4fT)." % (self._f[0], self._f[-1]))
+        return np.interp(field, self._f, self._i)
 
     
     def teslameter_set_range(self, fieldrange):
         if abs(fieldrange) <= 0.03:
-            self.Teslameter.set_range(30e-3)
-            time.sleep(1)
-            self.teslameter_multiplier = 0.01
+            teslameter_range, multiplier = 30e-3, 0.01
         elif abs(fieldrange) <= 0.3:
-            self.Teslameter.set_range(300e-3)
-            time.sleep(1)
-            self.teslameter_multiplier = 0.1          
+            teslameter_range, multiplier = 300e-3, 0.1
         else:
-            self.Teslameter.set_range(3000e-3)
+            teslameter_range, multiplier = 3000e-3, 1.0
+        if teslameter_range != self.teslameter_range:
+            self.Teslameter.set_range(teslameter_range)
             time.sleep(1)
-            self.teslameter_multiplier = 1.0
+            self.teslameter_range = teslameter_range
+        self.teslameter_multiplier = multiplier
         return
     
     
     def teslameter_read_field(self):
         # use the Keithley DMM6500 to read the analog output of the teslameter
-        v = self.dmm.get_measurement('VOLT:DC', 10.0, nplc=1, filterCount=4)
+        # a burst of 4 readings, averaged here instead of the DMM filter
+        v = self.dmm.get_measurement_buffer('VOLT:DC', 10.0, 4, nplc=1).mean()
+        return self.teslameter_correct(v)
+    
+    
+    def teslameter_correct(self, v):
+        # analog output voltage(s) to field, works on scalars and arrays
         v = v * self.teslameter_multiplier
         # nonlinearity correction for the FH55
-        c = 1 - 0.065/3*np.abs(v)
-        v = v*c
+        v *= (1.0 - self._NL*np.abs(v))
         return v
     
     
     def teslameter_read_field_ac(self):
-        self.Teslameter.set_mode("AC")
-        time.sleep(1)
+        self.teslameter_set_acdc("AC")
         self.teslameter_set_range(30e-3)
         time.sleep(1)
         v = self.Teslameter.get_singleFieldValue()
-        self.Teslameter.set_mode("DC")
-        time.sleep(1)
+        self.teslameter_set_acdc("DC")
         return v
         
             
     def teslameter_set_acdc(self, mode):
-        if mode in ["AC", "DC"]:
+        if mode in ["AC", "DC"] and mode != self.teslameter_mode:
             self.Teslameter.set_mode(mode)
             time.sleep(1)
+            self.teslameter_mode = mode
         return
             
     
@@ -191,7 +274,8 @@ class Field():
     def close(self):
         self.Teslameter.close()
         self.dmm.close()
-        self.Caenels.close()
+        # keep the power supply connection open for the next measurement
+        self.Caenels.close(disconnect=False)
 
 
 class FMR():
@@ -200,6 +284,10 @@ class FMR():
         self.system = System()
         self.field = Field()
         self.STOP = False
+        # lock-in X, Y and time stamps of a sweep, reused for all frequencies
+        self._sweepbuf = np.empty((3, 0))
+        # reads the teslameter while the lock-in settles
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         
         
     def stop(self):
@@ -208,57 +296,55 @@ class FMR():
         
         
     def kittel_resonance_field_ip(self, f, M, gamma_prime):
-        return - mu0*M/2 + np.sqrt(mu0**2 * M**2 / 4 + f**2 / gamma_prime**2)
+        return kittel_resonance_field_ip(f, M, gamma_prime)
     
     
     def kittel_resonance_field_oop(self, f, M, gamma_prime):
-        return abs(f / gamma_prime + mu0*M)
+        return kittel_resonance_field_oop(f, M, gamma_prime)
     
     
     def calc_B_range(self, B0, deltaB, multiplier=8, sampling=6, offset=0.0):
-        start = B0 - multiplier*deltaB
-        stop = B0 + multiplier*deltaB
-        step = deltaB / sampling
-        if start < 0.0:
-            start = 0.0
-        B = np.arange(start, stop+step, step) + offset
-        return B
+        return calc_B_range(B0, deltaB, multiplier=multiplier, sampling=sampling, offset=offset)
     
     
     def delta_B(self, f, alpha, deltaB0, gamma_prime):
-        return alpha * f / gamma_prime + deltaB0    
+        return delta_B(f, alpha, deltaB0, gamma_prime)
     
         
     def complex_rotate_array(self, X, Y, phase):
         # phase in degrees!
         p = phase / 180 * np.pi
-        C = X + 1j * Y
-        r = complex( np.cos(p), np.sin(p) )
-        V = r*C
-        return V.real, V.imag
+        # rotation of (X, Y) by p, same as multiplying X + iY with exp(ip)
+        c, s = np.cos(p), np.sin(p)
+        return c*X - s*Y, s*X + c*Y
     
     
     def autophase(self, X, Y):
         # brute-force the phase to minimize the quadrature component (Y) over the full measurement
+        # all phases at once: one row of the rotated Y per phase
         PHI = np.linspace(-90,90,181)
-        RMS = []
-        for phi in PHI:
-            X_, Y_ = self.complex_rotate_array(X, Y, phi)
-            rms = np.sqrt(np.sum(Y_**2))
-            RMS.append(rms)
-        i = np.argmin(np.array(RMS))
+        p = np.deg2rad(PHI)[:, None]
+        RMS = np.linalg.norm(np.sin(p)*X + np.cos(p)*Y, axis=1)
+        i = np.argmin(RMS)
         X_max, Y_min = self.complex_rotate_array(X, Y, PHI[i])
         print("\n\nAutophase correction: %i degree\n\n" % PHI[i])
         return X_max
     
     
+    def _sweep_buffers(self, n):
+        # grow the work arrays when a sweep is longer than all previous ones
+        if self._sweepbuf.shape[1] < n:
+            self._sweepbuf = np.empty((3, n))
+        return self._sweepbuf[0, :n], self._sweepbuf[1, :n], self._sweepbuf[2, :n]
+    
+    
     def get_offset(self):
         delay = 0.2
         B = np.linspace(-0.015, 0.015, 31)
         
         # get the corresponding magnet currents by interpolation
-        X = np.array([self.field.get_current_from_field(b) for b in B])
-        dX = np.mean(np.abs(X[1:] - X[:-1]))
+        X = self.field.get_current_from_field(B)
+        dX = np.abs(np.diff(X)).mean()
         
         fields = np.zeros_like(B)
         
@@ -296,14 +382,20 @@ class FMR():
         self.field.powersupply_output_off()
     
         
-        p = np.polyfit(B[2:], fields[2:], 1)
+        # straight line fit, closed form (the first two points are still settling)
+        x = B[2:]
+        y = fields[2:]
+        mx, my = x.mean(), y.mean()
+        slope = ((x-mx)*(y-my)).sum() / ((x-mx)**2).sum()
+        offset = -(my - slope*mx)
         
-        print("Offset: %8.5fT" % (-p[1]))
+        print("Offset: %8.5fT" % offset)
         
-        return -p[1]
+        return offset
     
     
-    def field_sweep(self, f, M, alpha, g, deltaB0, mode="ip", rampdown=True, offset=0.0, lowpass=0.05, delay=0.1, accuracy="fine", GUI=False):
+    def field_sweep(self, f, M, alpha, g, deltaB0, mode="ip", rampdown=True, offset=0.0, lowpass=0.05, delay=0.1, accuracy="fine", GUI=False, B0=None, deltaB=None):
+        # B0 and deltaB can be passed in when they are precomputed for all frequencies
         # estimate \gamma' from sample estimates
         gamma_prime = g*e/(2*me) / (2*np.pi)
         
@@ -316,10 +408,13 @@ class FMR():
         else:
             raise ValueError("Accuracy not recognized. Must be 'low', 'medium', or 'high'.")
         
-        if mode == "ip":
-            B0 = self.kittel_resonance_field_ip(f, M, gamma_prime)
-        elif mode == "oop":
-            B0 = self.kittel_resonance_field_oop(f, M, gamma_prime)
+        if B0 is None:
+            if mode == "ip":
+                B0 = self.kittel_resonance_field_ip(f, M, gamma_prime)
+            elif mode == "oop":
+                B0 = self.kittel_resonance_field_oop(f, M, gamma_prime)
+        if deltaB is None:
+            deltaB = self.delta_B(f, alpha, deltaB0, gamma_prime)
             
         print("\n\nExpected resonance field: %8.4f T \n\n " % B0)
         
@@ -327,18 +422,17 @@ class FMR():
             offset = 0
             print("High-field (>0.3T) measurement, disabling offset correction.\n\n")
             
-        B = self.calc_B_range(B0, self.delta_B(f, alpha, deltaB0, gamma_prime), multiplier=multiplier, sampling=sampling, offset=offset)
+        B = self.calc_B_range(B0, deltaB, multiplier=multiplier, sampling=sampling, offset=offset)
         
         # get the corresponding magnet currents by interpolation
-        X = np.array([self.field.get_current_from_field(b) for b in B])
+        X = self.field.get_current_from_field(B)
 
-        dX = np.mean(np.abs(X[1:] - X[:-1]))
+        dX = np.abs(np.diff(X)).mean()
         
-        voltages = np.zeros_like(B)
-        VX = np.zeros_like(B)
-        VY = np.zeros_like(B)
-        fields = np.zeros_like(B)
-        times = np.zeros_like(B)
+        # every point is written in the loop (or zeroed on STOP), no need to clear the arrays
+        # fields is returned and therefore not shared between sweeps
+        VX, VY, times = self._sweep_buffers(B.shape[0])
+        fields = np.empty_like(B)
         
         print("Minimum field: %.4fT | Maximum field: %.4fT | Field step: %.5fT" % (min(B), max(B), (max(B) - min(B))/(len(B)-1)))
         
@@ -365,26 +459,30 @@ class FMR():
         if GUI:
             print("\n<NEW_MEASUREMENT>\n")
         
+        progress = _PROG_FMT_GUI if GUI else _PROG_FMT
         starttime = time.time()
         for i in range(B.shape[0]):
             if self.STOP:
                 rampdown = True
+                VX[i:] = 0; VY[i:] = 0; fields[i:] = 0; times[i:] = 0
                 break
             
             self.field.powersupply_ramp_to_current(X[i], dX/(.2*delay))
             time.sleep(.8 * delay)
 
+            # the field has settled, read it in the background while the lock-in settles
+            field_read = self._executor.submit(self.field.teslameter_read_field)
             time.sleep(lowpass * self.system.timeconstant_multiplier)
 
-            fields[i] = self.field.teslameter_read_field()
+            fields[i] = field_read.result()
 
             x, y = self.system.lockin_read_XY()
             VX[i] = x
             VY[i] = y
-            if GUI:
-                print("\r<> Field: %8.5f T  | X: %12.8f V | Y: %12.8f V | Progress: %5.1f%% </>" % (fields[i], x, y, i/B.shape[0]*100), end="")
-            else:
-                print("\r Field: %8.5f T  | X: %12.8f V | Y: %12.8f V | Progress: %5.1f%% " % (fields[i], x, y, i/B.shape[0]*100), end="")
+            # one write per line (the GUI relies on it), the console is flushed every 10 steps
+            sys.stdout.write(progress.format(fields[i], x, y, i/B.shape[0]*100))
+            if not GUI and i % 10 == 0:
+                sys.stdout.flush()
                 
             times[i] = time.time()
     
@@ -402,12 +500,12 @@ class FMR():
     
         timing = endtime - starttime
         
-        time_diffs = times[1:] - times[0:-1]
-        time_per_step_avg = np.average(time_diffs)
+        time_diffs = np.diff(times)
+        time_per_step_avg = time_diffs.mean()
         time_per_step_med = np.median(time_diffs)
-        time_per_step_sdev = np.std(time_diffs)
-        time_per_step_max = np.max(time_diffs)
-        time_per_step_min = np.min(time_diffs)
+        time_per_step_sdev = time_diffs.std()
+        time_per_step_max = time_diffs.max()
+        time_per_step_min = time_diffs.min()
         
         print()
         print("Measurement loop timing : %.2fs" % timing)
@@ -421,16 +519,21 @@ class FMR():
         return fields, voltages
     
     
-    def writedatafile(self, zipfilename, filename, fields, voltages):
-        string = ""
-        for f, v in zip(fields, voltages):
-            string += "%14.10f %14.10f\n" % (f, v)
-            
-        zf = zipfile.ZipFile(zipfilename + ".zip", mode="a")    
-    
-        zf.writestr(filename, string)
-    
-        zf.close()
+    def openzipfile(self, zipfilename):
+        return zipfile.ZipFile(zipfilename + ".zip", mode="a", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+
+    def writedatafile(self, zipfilename, filename, fields, voltages, zf=None):
+        # format all lines at once
+        buf = io.StringIO()
+        np.savetxt(buf, np.column_stack([fields, voltages]), fmt="%14.10f %14.10f")
+        
+        # write into an already open archive, or open it just for this file
+        if zf is not None:
+            zf.writestr(filename, buf.getvalue())
+        else:
+            with self.openzipfile(zipfilename) as zf:
+                zf.writestr(filename, buf.getvalue())
         return
     
     
@@ -458,10 +561,16 @@ class FMR():
             print("Frequencies (GHz):")
             print(frequencies/1e9)
             
-            datasets = []
-        
-            power = self.system.signalgenerator_power(frequencies[0])
-            self.system.signalgenerator_settings(frequencies[0], power, 1)
+            # resonance fields, linewidths and powers of all frequencies at once
+            gamma_prime = g*e/(2*me) / (2*np.pi)
+            if mode == "ip":
+                B0s = kittel_resonance_field_ip(frequencies, M, gamma_prime)
+            elif mode == "oop":
+                B0s = kittel_resonance_field_oop(frequencies, M, gamma_prime)
+            deltaBs = delta_B(frequencies, alpha, deltaB0, gamma_prime)
+            powers = [self.system.signalgenerator_power(f) for f in frequencies]
+        
+            self.system.signalgenerator_settings(frequencies[0], powers[0], 1)
             
             
             self.system.lockin_settings(lowpass, self.system.modulator_frequency, output_voltage_rms, 1)
@@ -477,25 +586,31 @@ class FMR():
             time.sleep(2)
         
         if not self.STOP:
-            for f in frequencies:
-                if self.STOP:
-                    break
-                print("\nFrequency: %.2fGHz\n" % (f * 1e-9))
-                power = self.system.signalgenerator_power(f)
-                self.system.signalgenerator_settings(f, power, 1)
-                
-                
-                fields, voltages = self.field_sweep(f, M, alpha, g, deltaB0, mode=mode, rampdown=False, offset=offset, lowpass=lowpass, delay=delay, accuracy=accuracy, GUI=GUI)
-                
-                datasets.append([fields, voltages])
-                
-                filename = "%.2fGHz.txt" % (f * 1e-9)
-                self.writedatafile(zipfilename, filename, fields, voltages)
-                
-                if not GUI:
-                    pylab.plot(fields, voltages, label=filename)
-                    pylab.legend()
-                    pylab.show()
+            # the archive stays open for all frequencies, it is closed (and complete) after the last one or on an error
+            zf = self.openzipfile(zipfilename)
+            if not GUI:
+                # one live plot, updated after each frequency without blocking the measurement
+                plt.ion()
+                fig, ax = plt.subplots()
+            try:
+                for f, power, B0, deltaB in zip(frequencies, powers, B0s, deltaBs):
+                    if self.STOP:
+                        break
+                    print("\nFrequency: %.2fGHz\n" % (f * 1e-9))
+                    self.system.signalgenerator_settings(f, power, 1)
+                    
+                    
+                    fields, voltages = self.field_sweep(f, M, alpha, g, deltaB0, mode=mode, rampdown=False, offset=offset, lowpass=lowpass, delay=delay, accuracy=accuracy, GUI=GUI, B0=B0, deltaB=deltaB)
+                    
+                    filename = "%.2fGHz.txt" % (f * 1e-9)
+                    self.writedatafile(zipfilename, filename, fields, voltages, zf=zf)
+                    
+                    if not GUI:
+                        ax.plot(fields, voltages, label="%5.2fGHz" % (f * 1e-9))
+                        ax.legend()
+                        plt.pause(0.001)
+            finally:
+                zf.close()
         
         # graceful shutdown
         
@@ -510,18 +625,15 @@ class FMR():
         
         self.field.close()
         self.system.close()
-        
-        if not self.STOP:
-            for i in range(len(frequencies)):
-                fields, voltages = datasets[i]
-                if not GUI:
-                    pylab.plot(fields, voltages, label="%5.2fGHz" % (frequencies[i]/1e9))
-            
-            if not GUI:
-                pylab.legend()
-                pylab.xlabel("magnetic field (T)")
-                pylab.ylabel("detector diode derivative signal (arb. u.)")
-                pylab.show()
+        # the teslameter reads are done, release the worker thread (a new FMR is made for every run)
+        self._executor.shutdown(wait=False)
+        
+        if not self.STOP and not GUI:
+            # the live plot holds all frequencies, keep it open until it is closed
+            ax.set_xlabel("magnetic field (T)")
+            ax.set_ylabel("detector diode derivative signal (arb. u.)")
+            plt.ioff()
+            plt.show()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+ OpenFMR: tests for the Keithley6500 reply parsing, with a socket pair as the instrument
+"""
+
+import os
+import sys
+import socket
+import numpy as np
+import pytest
+
+pytest.importorskip('serial')
+pytest.importorskip('zhinst')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import devices
+
+
+def keithley(binary):
+    # a Keithley6500 connected to the returned peer socket, without initialize()
+    dmm = devices.Keithley6500()
+    dmm.device, peer = socket.socketpair()
+    dmm.device.settimeout(1)
+    dmm.min_nplc, dmm.max_nplc = 1e-4, 12.
+    dmm.binary = binary
+    return dmm, peer
+
+
+def test_buffer_binary_open_length_block():
+    dmm, peer = keithley(binary=True)
+    readings = np.array([0.1, -0.2, 0.3, 0.4])
+    # #0 header for the 4 readings, then a single reading that must not be disturbed
+    peer.sendall(b'#0' + readings.astype('<f8').tobytes() + b'\n')
+    peer.sendall(b'#0' + np.array([1.5], dtype='<f8').tobytes() + b'\n')
+    np.testing.assert_array_equal(dmm.get_measurement_buffer('VOLT:DC', 10., 4), readings)
+    assert dmm.read() == 1.5
+
+
+def test_buffer_ascii_larger_than_receive_buffer():
+    dmm, peer = keithley(binary=False)
+    readings = np.linspace(-1, 1, 1000)
+    reply = b','.join(repr(r).encode() for r in readings.tolist()) + b'\n'
+    assert len(reply) > 4096
+    peer.sendall(reply)
+    np.testing.assert_array_equal(dmm.get_measurement_buffer('VOLT:DC', 10., 1000), readings)
@@ -121,7 +121,8 @@ class Calibrate():
         
         Ia = I2[0:len(I2)//2]
 
-        B = np.mean([Ba, np.flipud(Bb)], axis=0)
+        # the down sweep in reverse order, averaged with the up sweep
+        B = 0.5 * (Ba + Bb[::-1])
         I = Ia
         
         return I, B
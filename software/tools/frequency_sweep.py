@@ -15,52 +15,156 @@
 
  You should have received a copy of the GNU General Public License
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
-"""v
+"""
 
+import sys
 import time 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import scipy.signal
 
 import devices
-import dsi
-
-import pylab
 
+# the plot is saved to a file, a window is only opened with --show
+SHOW = '--show' in sys.argv
+import matplotlib
+if not SHOW:
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# DMM integration per point: NPLC power line cycles (1 = 20 ms at 50 Hz) per reading,
+# FILTER_COUNT readings averaged. The time per point is about NPLC*FILTER_COUNT*20 ms, the
+# noise drops with the square root of it. Check the noise at a single frequency before
+# reducing them, e.g. NPLC=0.2 and FILTER_COUNT=1 are about 20x faster.
+NPLC = 1
+FILTER_COUNT = 4
+
+# measured data, read back with np.load
+OUTPUT = "frequency_sweep.npy"
+
+# adaptive grid: a coarse pass, then REFINE_POINTS points over +/- REFINE_SPAN around
+# every peak and dip of the coarse detector response, instead of the uniform fine grid
+ADAPTIVE = True
+COARSE_STEP = 1e9
+REFINE_SPAN = 1e9
+REFINE_POINTS = 21
+# only extrema that stand out by REFINE_PROMINENCE of the coarse voltage span are refined,
+# at most the MAX_REFINE most prominent ones, so detector noise cannot inflate the grid
+REFINE_PROMINENCE = 0.1
+MAX_REFINE = 4
+
+# time the tune / settle / read stages of every point, saved next to the data
+PROFILE = False
+timings = []
+
+
+def grid(start, stop, step):
+    # fixed number of points, float rounding cannot add one past stop
+    return np.linspace(start, stop, int(round((stop-start)/step))+1)
+
+
+def measure(f):
+    # tuning and reading stay in sequence: the frequency must not change while the DMM integrates
+    if not PROFILE:
+        signalgenerator.set_frequency(f)
+        signalgenerator.wait_settled()
+        return dmm.read()
+    t0 = time.perf_counter_ns()
+    signalgenerator.set_frequency(f)
+    t1 = time.perf_counter_ns()
+    signalgenerator.wait_settled()
+    t2 = time.perf_counter_ns()
+    v = dmm.read()
+    t3 = time.perf_counter_ns()
+    timings.append((t1-t0, t2-t1, t3-t2))
+    return v
    
+# one connection per instrument for the whole sweep, closed at the end
 dmm = devices.Keithley6500()
-dmm.initialize('192.168.0.2', 5025)         
+signalgenerator = devices.SG30000PRO()
 
-signalgenerator = dsi.SG30000PRO()
-signalgenerator.initialize("COM8")
+# the two instruments are independent, connect to both at the same time
+with ThreadPoolExecutor(max_workers=2) as ex:
+    f1 = ex.submit(dmm.initialize, '192.168.0.2', 5025)
+    f2 = ex.submit(signalgenerator.initialize, "COM8")
+    f1.result(); f2.result()
 
 signalgenerator.set_temperaturecalibration(0) # output drift, but no jumps and hickups
+
+# the DMM settings are sent once, every point is then a plain READ?
+dmm.configure('VOLT:DC', 1., nplc=NPLC, filterCount=FILTER_COUNT)
  
 # okay, let's try a little frequency sweep
 start = 1e9
 stop = 30e9
 step = 0.25e9
-frequencies = np.arange(start, stop+step, step)
-voltages = np.zeros_like(frequencies)
 
 signalgenerator.set_frequency(start)
 signalgenerator.set_power(12)
 signalgenerator.set_output(1)
 signalgenerator.set_buzzer(0)
 
-
-for i in range(frequencies.shape[0]):
-    signalgenerator.set_frequency(frequencies[i])
-    time.sleep(0.05)
-    voltages[i] = dmm.get_measurement('VOLT:DC', 1., nplc=1, filterCount=4)
+if ADAPTIVE:
+    coarse = np.round(grid(start, stop, COARSE_STEP) / 1e6) * 1e6
+    coarse_voltages = np.empty(coarse.shape[0], dtype=np.float64)
+    for i in range(coarse.shape[0]):
+        coarse_voltages[i] = measure(coarse[i])
+    prominence = REFINE_PROMINENCE * np.ptp(coarse_voltages)
+    dips, dip_props = scipy.signal.find_peaks(-coarse_voltages, prominence=prominence)
+    peaks, peak_props = scipy.signal.find_peaks(coarse_voltages, prominence=prominence)
+    extrema = np.concatenate([dips, peaks])
+    order = np.argsort(np.concatenate([dip_props["prominences"], peak_props["prominences"]]))[::-1]
+    extrema = extrema[order[:MAX_REFINE]]
+    refine = [np.linspace(coarse[j]-REFINE_SPAN, coarse[j]+REFINE_SPAN, REFINE_POINTS) for j in extrema]
+    # the generator is set in whole MHz, rounding merges points that coincide
+    frequencies = np.unique(np.round(np.clip(np.concatenate([coarse] + refine), start, stop) / 1e6) * 1e6)
+else:
+    frequencies = grid(start, stop, step)
+
+# frequency and voltage columns in a .npy file on disk, every point is written through as
+# it is measured, so a crash keeps the points up to there (not measured yet: NaN)
+data = np.lib.format.open_memmap(OUTPUT, mode='w+', dtype=np.float64, shape=(frequencies.shape[0], 2))
+data[:, 0] = frequencies
+data[:, 1] = np.nan
+voltages = data[:, 1]
+
+todo = np.arange(frequencies.shape[0])
+if ADAPTIVE:
+    # the coarse points are measured already (both arrays are sorted)
+    done = np.isin(frequencies, coarse)
+    voltages[done] = coarse_voltages
+    todo = todo[~done]
+
+for i in todo:
+    voltages[i] = measure(frequencies[i])
+
+data.flush()
+
+if PROFILE:
+    # per point and stage in ms, in measurement order
+    t = np.array(timings) * 1e-6
+    np.savetxt(OUTPUT.replace(".npy", "_timing.csv"), t, fmt="%.3f", delimiter=",", header="tune_ms,settle_ms,read_ms")
+    for name, col in zip(("tune", "settle", "read"), t.T):
+        print("%-6s mean %8.3f ms | p95 %8.3f ms | p99 %8.3f ms" % (name, col.mean(), np.percentile(col, 95), np.percentile(col, 99)))
 
 signalgenerator.set_buzzer(1)
 signalgenerator.set_output(0)
 
-pylab.plot(frequencies/1e9, -voltages)
-pylab.xlabel("frequency (GHz)")
-pylab.ylabel("detector diode voltage (V)")
-pylab.yscale("log")
-
-signalgenerator.close()
-dmm.close()
+# release the instruments first, plotting is not part of the measurement
+with ThreadPoolExecutor(max_workers=2) as ex:
+    f1 = ex.submit(signalgenerator.close)
+    f2 = ex.submit(dmm.close)
+    f1.result(); f2.result()
+
+# GHz in place, the file has its own copy of the frequencies; the voltages are the file
+# itself and must not be negated in place
+np.multiply(frequencies, 1e-9, out=frequencies)
+plt.plot(frequencies, -voltages)
+plt.xlabel("frequency (GHz)")
+plt.ylabel("detector diode voltage (V)")
+plt.yscale("log")
+plt.savefig(OUTPUT.replace(".npy", ".png"), dpi=150)
+if SHOW:
+    plt.show()
 
 